@@ -126,7 +126,7 @@ def prepare_simple_lens_model_from_h5(h5file, imagecoords=None, debug=False, mod
 class SimpleLensedQuasarModel:
     def __init__(self, data, noisemap, narrowpsf, upsampling_factor,
                  initial_guess_no_galaxy, initial_guess_with_galaxy, wcs=None,
-                 modeltype='simple'):
+                 modeltype='simple', interpolation='bicubic'):
         """
 
         :param data: 2D np array
@@ -139,6 +139,11 @@ class SimpleLensedQuasarModel:
         :param modeltype: string, either 'simple' or 'mcs'. with 'simple', we just interpolate and scale the PSFs
                           onto the grid. With 'mcs', we interpolate 2D gaussians and sersics onto a finer grid
                           (PSF resolution), then convolve with the PSF and downsample to the image resolution.
+        :param interpolation: string, default 'bicubic'. Method used by `jax.image.scale_and_translate` to
+                              interpolate the PSF onto the model grid with modeltype 'simple'. 'linear' is about
+                              twice cheaper per pixel, at the cost of a slightly smoother PSF. With 'fft', the
+                              PSF is interpolated onto the grid once, and translated by phase shifts in Fourier
+                              space (periodic: the PSF must fall off before the edges of the model).
 
         """
 
@@ -152,10 +157,12 @@ class SimpleLensedQuasarModel:
         noisemap /= scale
 
         self.scale = scale
-        self.data = data
-        self.noisemap = noisemap
+        # single precision device arrays: no upload at each call of the likelihood, half the memory traffic.
+        self.data = jnp.asarray(data, dtype=jnp.float32)
+        self.noisemap = jnp.asarray(noisemap, dtype=jnp.float32)
 
         self.upsampling_factor = upsampling_factor
+        self.interpolation = interpolation
         self.wcs = wcs
 
         self.modeltype = modeltype
@@ -177,12 +184,17 @@ class SimpleLensedQuasarModel:
         if modeltype == 'mcs':
             Nx, Ny = upsampling_factor * Nx, upsampling_factor * Ny
             padx, pady = int((Nx - nx) / 2), int((Ny - ny) / 2)
-            self.psf = jnp.pad(narrowpsf, ((padx, padx), (pady, pady)), constant_values=0.)
+            self.psf = jnp.pad(jnp.asarray(narrowpsf, dtype=jnp.float32), ((padx, padx), (pady, pady)),
+                               constant_values=0.)
         elif modeltype == 'simple':
-            self.psf = gaussian_filter(narrowpsf, 0.85)  # narrow psf --> psf by convolving with gaussian kernel fwhm=2
+            # narrow psf --> psf by convolving with gaussian kernel fwhm=2
+            self.psf = jnp.asarray(gaussian_filter(narrowpsf, 0.85), dtype=jnp.float32)
 
         x, y = np.arange(-Ny//2, Ny//2), np.arange(-Nx//2, Nx//2)
-        self.X, self.Y = np.meshgrid(x, y)
+        # on the device once and for all, rather than at each call of the jitted models.
+        self.X, self.Y = jnp.meshgrid(jnp.asarray(x), jnp.asarray(y))
+        if interpolation == 'fft':
+            self.psf_fft = jnp.fft.rfft2(self._interpolate_psf(0., 0., 'bicubic'))
 
         self.initial_guess_no_galaxy = initial_guess_no_galaxy
         self.initial_guess_with_galaxy = initial_guess_with_galaxy
@@ -196,13 +208,16 @@ class SimpleLensedQuasarModel:
         # Ellipticity and orientation parameters
         q = 1 - ellip
         theta = jnp.radians(theta)
-        xt = (self.X - x0) * jnp.cos(theta) + (self.Y - y0) * jnp.sin(theta)
-        yt = (self.Y - y0) * jnp.cos(theta) - (self.X - x0) * jnp.sin(theta)
-        # radius
-        r = jnp.sqrt(xt ** 2 + (yt / q) ** 2)
+        cos, sin = jnp.cos(theta), jnp.sin(theta)
+        # rotation of the (X - x0, Y - y0) coordinate pairs in a single product
+        coords = jnp.stack([self.X - x0, self.Y - y0], axis=-1)
+        rotated = coords @ jnp.array([[cos, -sin], [sin, cos]])
+        xt, yt = rotated[..., 0], rotated[..., 1]
+        # squared radius: (r / r_e) ** (1 / n) is (r2 / r_e ** 2) ** (1 / (2 n)), no square root needed.
+        r2 = xt ** 2 + (yt / q) ** 2
         # sersicersic profile
         bn = 1.9992 * n - 0.3271  # approximation valid for 0.5 < n < 10
-        return I_e * jnp.exp(-bn * ((r / r_e) ** (1 / n) - 1))
+        return I_e * jnp.exp(-bn * ((r2 / r_e ** 2) ** (0.5 / n) - 1))
 
     def gaussian_psf(self, x0, y0, A):
         """Calculate the value of a 2D Gaussian PSF."""
@@ -211,6 +226,16 @@ class SimpleLensedQuasarModel:
         return g
 
     def translate_and_scale_psf(self, dx, dy, amplitude):
+        if self.interpolation == 'fft':
+            # the translation is a phase shift of the PSF interpolated onto the grid once and for all.
+            outshape = self.X.shape
+            ky = jnp.fft.fftfreq(outshape[0])[:, None]
+            kx = jnp.fft.rfftfreq(outshape[1])[None, :]
+            phase = jnp.exp(-2j * jnp.pi * (ky * dy + kx * dx))
+            return amplitude * jnp.fft.irfft2(self.psf_fft * phase, s=outshape)
+        return amplitude * self._interpolate_psf(dx, dy, self.interpolation)
+
+    def _interpolate_psf(self, dx, dy, method):
         outshape = self.X.shape
         supersampling = self.upsampling_factor
         scale = jnp.array((1. / supersampling, 1. / supersampling))
@@ -222,8 +247,7 @@ class SimpleLensedQuasarModel:
 
         # assuming
         translation = jnp.array((dy + outoffsetx, dx + outoffsety))
-        out = scale_and_translate(self.psf, outshape, (0, 1), scale, translation, method='bicubic')
-        return amplitude * out
+        return scale_and_translate(self.psf, outshape, (0, 1), scale, translation, method=method)
 
     def _create_model_no_galaxy(self, x1, y1, A1, x2, y2, A2):
         psf1 = self.gaussian_psf(x1, y1, A1)
@@ -266,12 +290,12 @@ class SimpleLensedQuasarModel:
 
     @partial(jit, static_argnums=(0,))
     def residuals_with_galaxy(self, params):
-        model = self.model_with_galaxy(params)
+        model = self.model_with_galaxy(params).astype(jnp.float32)
         return ((model - self.data) / self.noisemap).flatten()
 
     @partial(jit, static_argnums=(0,))
     def residuals_no_galaxy(self, params):
-        model = self.model_no_galaxy(params)
+        model = self.model_no_galaxy(params).astype(jnp.float32)
         return ((model - self.data) / self.noisemap).flatten()
 
     def reduced_chi2_no_galaxy(self, params):
@@ -307,13 +331,9 @@ class SimpleLensedQuasarModel:
     def sample_with_galaxy(self, num_warmup=100, num_samples=200, num_chains=1):
 
         def numpyromodel(data, noise):
-            # Flatten the images
-            image_data_flat = data.flatten()
-            image_uncertainties_flat = noise.flatten()
-            # this basically allows us to use the numypro.plate context manager
-            # below. Not very useful here, but indicates that each pixel
-            # is independant. Some samplers can take advantage of this,
-            # so let's do it this way.
+            # the pixels are independent: the likelihood below is a single event over all of them
+            # (no plate over the pixels, it would only add broadcasting work at each step). The images keep
+            # their shape, nothing is flattened (copied) at each step.
 
             sizey, sizex = data.shape
             boundx, boundy = (sizex - 1.) / 2., (sizey - 1.) / 2.
@@ -339,8 +359,7 @@ class SimpleLensedQuasarModel:
             mod = self.model_with_galaxy([x1, y1, A1, x2, y2, A2, xg, yg, I_e, r_e, n, ellip, theta])
 
             # likelihood, gaussian errors
-            with numpyro.plate('data', len(image_data_flat)):
-                numpyro.sample('obs', dist.Normal(mod.flatten(), image_uncertainties_flat), obs=image_data_flat)
+            numpyro.sample('obs', dist.Normal(mod, noise).to_event(data.ndim), obs=data)
 
         # run MCMC
         nuts_kernel = numpyro.infer.NUTS(numpyromodel)
@@ -356,13 +375,9 @@ class SimpleLensedQuasarModel:
     def sample_no_galaxy(self, num_warmup=500, num_samples=500, num_chains=1):
 
         def numpyromodel(data, noise):
-            # Flatten the images
-            image_data_flat = data.flatten()
-            image_uncertainties_flat = noise.flatten()
-            # this basically allows us to use the numypro.plate context manager
-            # below. Not very useful here, but indicates that each pixel
-            # is independant. Some samplers can take advantage of this,
-            # so let's do it this way.
+            # the pixels are independent: the likelihood below is a single event over all of them
+            # (no plate over the pixels, it would only add broadcasting work at each step). The images keep
+            # their shape, nothing is flattened (copied) at each step.
 
             sizey, sizex = data.shape
             boundx, boundy = (sizex - 1.) / 2., (sizey - 1.) / 2.
@@ -380,8 +395,7 @@ class SimpleLensedQuasarModel:
             mod = self.model_no_galaxy([x1, y1, A1, x2, y2, A2])
 
             # likelihood, gaussian errors
-            with numpyro.plate('data', len(image_data_flat)):
-                numpyro.sample('obs', dist.Normal(mod.flatten(), image_uncertainties_flat), obs=image_data_flat)
+            numpyro.sample('obs', dist.Normal(mod, noise).to_event(data.ndim), obs=data)
 
         # run MCMC
         nuts_kernel = numpyro.infer.NUTS(numpyromodel)
@@ -9,6 +9,7 @@ from scipy.ndimage import gaussian_filter, map_coordinates, center_of_mass, shif
 
 from jax import jit
 from jax import vmap
+from jax import ensure_compile_time_eval
 from functools import partial
 import jax.numpy as jnp
 from jax.scipy.signal import fftconvolve
@@ -109,7 +110,14 @@ def psf_cleaner(psf, frac_suppressed=0.25):
 
 
 class DoublyLensedQuasarFitter:
-    def __init__(self, data, noisemap, narrowpsf, upsampling_factor, bandnames, filter_psf):
+    # default for the instances restored by `from_hdf5`, which do not go through __init__
+    interpolation = 'bicubic'
+    # where the fitted parameters are stored
+    _param_attributes = ('param_optim_no_galaxy', 'param_optim_with_galaxy',
+                         'param_mediansampler_no_galaxy', 'param_mediansampler_with_galaxy')
+
+    def __init__(self, data, noisemap, narrowpsf, upsampling_factor, bandnames, filter_psf,
+                 interpolation='bicubic'):
         """
         A class that will hold your data in different bands (cutouts, noisemaps, psfs).
         Its end goal is using its `sample` method to blindly fit two PSFs to the data, and potentially a
@@ -126,6 +134,10 @@ class DoublyLensedQuasarFitter:
         :param filter_psf: bool, default True. Supress the edges of the PSF. Can be a decent safety given our method of
                            psf modelling. If the PSF is completely out of control, might suppress useful regions. But
                            in this case this whole endeavor would be useless ...
+        :param interpolation: string, default 'bicubic'. Method used by `jax.image.scale_and_translate` to
+                              interpolate the PSFs onto the model grid. 'linear' is about twice cheaper per
+                              pixel, at the cost of a slightly smoother PSF. With 'fft', the PSFs are
+                              interpolated onto the grid once, and translated by phase shifts in Fourier space.
 
         """
 
@@ -144,6 +156,7 @@ class DoublyLensedQuasarFitter:
         self.noisemap = noisemap
 
         self.upsampling_factor = upsampling_factor
+        self.interpolation = interpolation
         self.bands = bandnames
 
         nband, Nx, Ny = shape
@@ -163,6 +176,7 @@ class DoublyLensedQuasarFitter:
         self.param_mediansampler_no_galaxy = None
         self.param_mediansampler_with_galaxy = None
         self.mcmc = None
+        self._mcmc_signature = None
 
     def remove_band(self, bandname):
         """
@@ -180,6 +194,55 @@ class DoublyLensedQuasarFitter:
         self.data = np.delete(self.data, index, 0)
         self.noisemap = np.delete(self.noisemap, index, 0)
         self.psf = np.delete(self.psf, index, 0)
+        # the band dependant parameters are stacked along a band axis, they lose this band too.
+        for attribute in self._param_attributes:
+            params = getattr(self, attribute)
+            if params is not None:
+                setattr(self, attribute, self.delete_band_from_params(params, index))
+
+    @staticmethod
+    def delete_band_from_params(params, index):
+        """
+        removes the band number `index` out of a dictionary of parameters (see `model_no_galaxy` for its layout).
+        :param params: dictionary of parameters
+        :param index: int, index of the band in the band axis of the stacked parameters.
+        :return: a new dictionary of parameters, without this band.
+        """
+        params = dict(params)
+        params['A'] = np.delete(np.asarray(params['A']), index, 1)
+        params['offsets'] = np.delete(np.asarray(params['offsets']), index, 0)
+        if 'I_e' in params.get('galparams', {}):
+            params['galparams'] = dict(params['galparams'])
+            params['galparams']['I_e'] = np.delete(np.asarray(params['galparams']['I_e']), index, 0)
+        return params
+
+    def _freeze_psf(self):
+        """
+        makes `self.psf` read-only, as the caches derived from it are keyed on its identity (it must be replaced,
+        not modified in place). Note that the jitted models, compiled for this instance, keep the PSF they were
+        traced with: after replacing the PSF, rather work with a new instance.
+        :return: self.psf
+        """
+        if isinstance(self.psf, np.ndarray):
+            self.psf.flags.writeable = False
+        return self.psf
+
+    @property
+    def sersic_psfs(self):
+        """
+        The PSFs by which we convolve the sersic profiles, interpolated onto the grid of the model.
+        They do not depend on the parameters, so we compute them only once instead of at every call of the model,
+        and again only if `self.psf` is replaced (e.g. by `remove_band`). `self.psf` is made read-only here, an
+        in-place modification would leave these stale (see `_freeze_psf`).
+        :return: 3D array, one PSF per band.
+        """
+        if getattr(self, '_sersic_psfs_source', None) is not self.psf:
+            # we might be accessed while a model is being traced by jit: make sure we still compute actual values.
+            with ensure_compile_time_eval():
+                psfs = jnp.array([self.translate_and_scale_psf(-0.5, -0.5, 1., psf) for psf in self.psf])
+            self._sersic_psfs = np.asarray(psfs)
+            self._sersic_psfs_source = self._freeze_psf()
+        return self._sersic_psfs
 
     def elliptical_sersic_profile(self, I_e, r_e, x0, y0, n, ellip, theta):
         # ellipticity and orientation parameters
@@ -187,12 +250,12 @@ class DoublyLensedQuasarFitter:
         theta = jnp.radians(theta)
         xt = (self.X - x0) * jnp.cos(theta) + (self.Y - y0) * jnp.sin(theta)
         yt = (self.Y - y0) * jnp.cos(theta) - (self.X - x0) * jnp.sin(theta)
-        # radius
-        r = jnp.sqrt(xt ** 2 + (yt / q) ** 2)
+        # squared radius: (r / r_e) ** (1 / n) is (r2 / r_e ** 2) ** (1 / (2 n)), no square root needed.
+        r2 = xt ** 2 + (yt / q) ** 2
         # sersic profile
         # let's fix n ...
         bn = 1.9992 * n - 0.3271  # approximation valid for 0.5 < n < 10
-        profilewow = jnp.exp(-bn * ((r / r_e) ** (1. / n) - 1))
+        profilewow = jnp.exp(-bn * ((r2 / r_e ** 2) ** (0.5 / n) - 1))
         profilewow /= profilewow.sum()
         profile = I_e * profilewow
 
@@ -220,12 +283,19 @@ class DoublyLensedQuasarFitter:
           (could be x,y but since this is a translation, called them dx, dy) and multiplies the result by the
           amplitude. This is a way of adding the PSF to the model.
           This method is used in the `self.model*` functions.
+          With `self.interpolation == 'fft'`, the PSF is interpolated (bicubic) onto the grid without translation,
+          and the translation is done as a phase shift of its Fourier transform, see `shift_psf_fft`.
         :param dx: float, x coordinate of the point source to be modelled
         :param dy: float, y coordinate of the point source to be modelled
         :param amplitude: some kind of flux.
         :param psf: the actual array to be interpolated onto the model.
         :return: the downscaled, translated and multiplied by amplitude PSF, ready to be added to the model.
         """
+        if self.interpolation == 'fft':
+            return self.shift_psf_fft(dx, dy, amplitude, jnp.fft.rfft2(self._interpolate_psf(0., 0., psf, 'bicubic')))
+        return amplitude * self._interpolate_psf(dx, dy, psf, self.interpolation)
+
+    def _interpolate_psf(self, dx, dy, psf, method):
         outshape = self.X.shape
         supersampling = self.upsampling_factor
         scale = jnp.array((1. / supersampling, 1. / supersampling))
@@ -237,32 +307,82 @@ class DoublyLensedQuasarFitter:
 
         # assuming
         translation = jnp.array((dy + outoffsetx, dx + outoffsety))
-        out = scale_and_translate(psf, outshape, (0, 1), scale, translation, method='bicubic')
-        return amplitude * out
+        return scale_and_translate(psf, outshape, (0, 1), scale, translation, method=method)
+
+    def shift_psf_fft(self, dx, dy, amplitude, psf_fft):
+        """
+          translates a PSF already on the grid of the model by dx, dy, as a phase ramp on its Fourier transform.
+          This is exact for band limited PSFs, smooth in dx and dy, and costs two small FFTs. Beware that the
+          translation is periodic: the PSF must fall off before the edges of the model.
+        :param dx: float, translation along x
+        :param dy: float, translation along y
+        :param amplitude: some kind of flux.
+        :param psf_fft: 2D array, `jnp.fft.rfft2` of the PSF interpolated onto the grid of the model.
+        :return: the translated PSF, multiplied by amplitude.
+        """
+        outshape = self.X.shape
+        ky = jnp.fft.fftfreq(outshape[0])[:, None]
+        kx = jnp.fft.rfftfreq(outshape[1])[None, :]
+        phase = jnp.exp(-2j * jnp.pi * (ky * dy + kx * dx))
+        return amplitude * jnp.fft.irfft2(psf_fft * phase, s=outshape)
+
+    @property
+    def psf_ffts(self):
+        """
+        For `self.interpolation == 'fft'`: the Fourier transforms of the PSFs interpolated onto the grid of the model
+        without translation. Like `sersic_psfs`, computed once and again only if `self.psf` is replaced.
+        :return: 3D complex array, one transform per band.
+        """
+        if getattr(self, '_psf_ffts_source', None) is not self.psf:
+            with ensure_compile_time_eval():
+                ffts = jnp.array([jnp.fft.rfft2(self._interpolate_psf(0., 0., psf, 'bicubic')) for psf in self.psf])
+            self._psf_ffts = np.asarray(ffts)
+            self._psf_ffts_source = self._freeze_psf()
+        return self._psf_ffts
 
     @partial(jit, static_argnums=(0,))
     def model_no_galaxy(self, params):
         """
          interpolates the PSF at the positions and amplitudes specified by the `params` dictionary, in each band.
-        :param params: dictionary of parameters
+        :param params: dictionary of parameters. The band dependant ones are stacked in arrays, in the order of
+                       `self.bands`:
+                       {'positions': (x1, y1, x2, y2),
+                        'A': amplitudes of the two point sources, shape (2, nband),
+                        'offsets': alignment offsets (dx, dy) of each band, shape (nband, 2),
+                        'galparams': {'positions': (xg, yg), 'morphology': (r_e, n, ellip, theta),
+                                      'I_e': amplitude of the sersic, shape (nband,)}}
+                       where 'galparams' is only needed by `model_with_galaxy`.
         :return: 3D array containing the model.
         """
 
-        x1, y1, x2, y2 = params['positions']
-
-        A1s = jnp.array([params[band][0] for band in self.bands])
-        A2s = jnp.array([params[band][1] for band in self.bands])
+        model = self.point_sources(params).sum(axis=0)
+        return model
 
-        xs1 = jnp.array([x1 + params[f'offsets_{band}'][0] for band in self.bands])
-        ys1 = jnp.array([y1 + params[f'offsets_{band}'][1] for band in self.bands])
-        xs2 = jnp.array([x2 + params[f'offsets_{band}'][0] for band in self.bands])
-        ys2 = jnp.array([y2 + params[f'offsets_{band}'][1] for band in self.bands])
-        vecpsf = vmap(lambda x, y, a, psf: self.translate_and_scale_psf(x, y, a, psf), in_axes=(0, 0, 0, 0))
-        p1 = vecpsf(xs1, ys1, A1s, self.psf)
-        p2 = vecpsf(xs2, ys2, A2s, self.psf)
+    def point_sources(self, params):
+        """
+         interpolates the PSF of each band at the positions and amplitudes of both point sources. The two point
+         sources of all bands go through a single vmap, that is a single batched interpolation.
+        :param params: dictionary of parameters
+        :return: 4D array of shape (2, nband, Nx, Ny), the point sources 1 and 2 in each band.
+        """
+        x1, y1, x2, y2 = params['positions']
+        offsets = jnp.asarray(params['offsets'])
+
+        # stack the two point sources: (2, nband), flattened to a single batch of 2*nband interpolations.
+        nband = len(self.bands)
+        xs = jnp.stack([x1 + offsets[:, 0], x2 + offsets[:, 0]]).reshape(2 * nband)
+        ys = jnp.stack([y1 + offsets[:, 1], y2 + offsets[:, 1]]).reshape(2 * nband)
+        As = jnp.asarray(params['A']).reshape(2 * nband)
+        if self.interpolation == 'fft':
+            # the interpolation onto the grid is already done, only the phase shifts remain.
+            psfs, translate = self.psf_ffts, self.shift_psf_fft
+        else:
+            psfs, translate = self.psf, self.translate_and_scale_psf
+        psfs = jnp.broadcast_to(psfs, (2,) + psfs.shape).reshape((2 * nband,) + psfs.shape[1:])
 
-        model = p1 + p2
-        return model
+        vecpsf = vmap(translate, in_axes=(0, 0, 0, 0))
+        pointsources = vecpsf(xs, ys, As, psfs)
+        return pointsources.reshape((2, nband) + pointsources.shape[1:])
 
     @partial(jit, static_argnums=(0,))
     def model_with_galaxy(self, params):
@@ -276,10 +396,11 @@ class DoublyLensedQuasarFitter:
         model = self.model_no_galaxy(params)
         # next, prepare the sersic params:
         xg, yg = params['galparams']['positions']
-        xgs = jnp.array([xg + params[f'offsets_{band}'][0] for band in self.bands])
-        ygs = jnp.array([yg + params[f'offsets_{band}'][1] for band in self.bands])
-        I_es = jnp.array([params['galparams'][f'I_e_{band}'] for band in self.bands])
-        psfs = jnp.array([self.translate_and_scale_psf(-0.5, -0.5, 1., self.psf[i]) for i in range(len(self.bands))])
+        offsets = jnp.asarray(params['offsets'])
+        xgs = xg + offsets[:, 0]
+        ygs = yg + offsets[:, 1]
+        I_es = jnp.asarray(params['galparams']['I_e'])
+        psfs = self.sersic_psfs
         r_e, n, ellip, theta = params['galparams']['morphology']
         # we'll have to produce one model per band, vectorize
         vecsersic = vmap(
@@ -371,7 +492,7 @@ class DoublyLensedQuasarFitter:
 
     def sample(self, num_warmup=20_000, num_samples=10_000, num_chains=1,
                position_scale=10., positions_prior_type="box", max_band_offset=1.,
-               include_galaxy=True, force_galaxy_between_points=True):
+               include_galaxy=True, force_galaxy_between_points=True, sampler='barker', reuse_warmup=False):
         """
         Trying to fit our data without initial guess with a sampler. Advice: use an insanely large number of steps,
         because no more half measures. It takes approximately 2 minutes on a GPU for 100_000 steps so yeah ...
@@ -387,19 +508,20 @@ class DoublyLensedQuasarFitter:
         :param include_galaxy: bool, whether we include extra parameters for a Sersic profile in the model.
         :param force_galaxy_between_points: bool, default True, whether the galaxy is forced to lie somewhere
                                             between the lensed images or not.
+        :param sampler: string, default 'barker'. Either 'barker' (BarkerMH) or 'nuts' (NUTS, with a diagonal
+                        mass matrix adapted during the warmup).
+        :param reuse_warmup: bool, default False. If the previous call to this method used the same settings,
+                             continue its chain from its last state: the warmup (adaptation of the step size and
+                             mass matrix) is skipped, and the compiled sampler is re-used.
         :return: numpyro.infer MCMC class used to do the sampling here
 
         params are updated in class, then you can use the plot functions which will use the medians of the
         class attributes. (self.param_mediansampler_no_galaxy)
         """
         def numpyromodel(data, noise):
-            # Flatten the images
-            image_data_flat = data.flatten()
-            image_uncertainties_flat = noise.flatten()
-            # this basically allows us to use the numypro.plate context manager
-            # below. Not very useful here, but indicates that each pixel
-            # is independant. Some samplers can take advantage of this,
-            # so let's do it this way just in case it becomes useful.
+            # the pixels are independent: the likelihood below is a single event over all of them
+            # (no plate over the pixels, it would only add broadcasting work at each step). The images keep
+            # their shape, nothing is flattened (copied) at each step.
 
             _, sizey, sizex = data.shape
 
@@ -422,14 +544,14 @@ class DoublyLensedQuasarFitter:
                 y2 = numpyro.sample('y2', dist.Normal(loc=0., scale=position_scale))
 
             params['positions'] = (x1, y1, x2, y2)
-            # ok, now populate the band-dependant params:
-            for band in self.bands:
-                A1 = numpyro.sample(f'A1_{band}', dist.Uniform(-100., 200.))  # since we normalize our data, this range
-                A2 = numpyro.sample(f'A2_{band}', dist.Uniform(-100., 200.))  # should be fine ...
-                params[band] = (A1, A2)
-                dx = numpyro.sample(f'dx_{band}', dist.Uniform(-max_band_offset, max_band_offset))
-                dy = numpyro.sample(f'dy_{band}', dist.Uniform(-max_band_offset, max_band_offset))
-                params[f'offsets_{band}'] = dx, dy
+            # ok, now populate the band-dependant params, one vector site per parameter (one element per band):
+            with numpyro.plate('bands', len(self.bands)):
+                A1 = numpyro.sample('A1', dist.Uniform(-100., 200.))  # since we normalize our data, this range
+                A2 = numpyro.sample('A2', dist.Uniform(-100., 200.))  # should be fine ...
+                dx = numpyro.sample('dx', dist.Uniform(-max_band_offset, max_band_offset))
+                dy = numpyro.sample('dy', dist.Uniform(-max_band_offset, max_band_offset))
+            params['A'] = jnp.stack([A1, A2])
+            params['offsets'] = jnp.stack([dx, dy], axis=1)
 
             if not include_galaxy:
                 # then we stop here and use the simple model.
@@ -464,23 +586,35 @@ class DoublyLensedQuasarFitter:
                 params['galparams']['morphology'] = r_e, n, ellip, theta
 
                 # band dependant params
-                params['galparams']['I_e'] = {}
-                for band in self.bands:
-                    params['galparams'][f'I_e_{band}'] = numpyro.sample(f'I_e_{band}', dist.Uniform(0., 30.))
+                with numpyro.plate('bands', len(self.bands)):
+                    params['galparams']['I_e'] = numpyro.sample('I_e', dist.Uniform(0., 30.))
 
                 mod = self.model_with_galaxy(params)
 
             # likelihood, gaussian errors
-            with numpyro.plate('data', len(image_data_flat)):
-                numpyro.sample('obs', dist.Normal(mod.flatten(), image_uncertainties_flat), obs=image_data_flat)
-
-        # run MCMC, this barkerMH kernel seems to be working well.
-        # NUTS was getting stuck too much.
-        kernel = numpyro.infer.BarkerMH(numpyromodel)
-        mcmc = numpyro.infer.MCMC(kernel, num_warmup=num_warmup, num_samples=num_samples, num_chains=num_chains)
-        rng_key = random.PRNGKey(0)
-        breakpoint()
-        mcmc.run(rng_key, self.data, self.noisemap)
+            numpyro.sample('obs', dist.Normal(mod, noise).to_event(data.ndim), obs=data)
+
+        signature = (sampler, position_scale, positions_prior_type, max_band_offset, include_galaxy,
+                     force_galaxy_between_points, num_chains, tuple(self.bands), self.data.shape)
+        if reuse_warmup and self.mcmc is not None and self._mcmc_signature == signature:
+            # same model: carry on from where the previous chain stopped, already adapted.
+            mcmc = self.mcmc
+            mcmc.num_samples = num_samples
+            mcmc.post_warmup_state = mcmc.last_state
+            mcmc.run(mcmc.post_warmup_state.rng_key, self.data, self.noisemap)
+        else:
+            # run MCMC, this barkerMH kernel seems to be working well.
+            # NUTS was getting stuck too much with the default settings.
+            if sampler == 'barker':
+                kernel = numpyro.infer.BarkerMH(numpyromodel)
+            elif sampler == 'nuts':
+                kernel = numpyro.infer.NUTS(numpyromodel, dense_mass=False, target_accept_prob=0.9, max_tree_depth=8)
+            else:
+                raise AssertionError("sampler is either 'barker' or 'nuts'")
+            mcmc = numpyro.infer.MCMC(kernel, num_warmup=num_warmup, num_samples=num_samples, num_chains=num_chains)
+            rng_key = random.PRNGKey(0)
+            mcmc.run(rng_key, self.data, self.noisemap)
+        self._mcmc_signature = signature
         mcmc.print_summary()
         self.unpack_params_mcmc(mcmc, include_galaxy)
         self.mcmc = mcmc
@@ -489,17 +623,16 @@ class DoublyLensedQuasarFitter:
     def unpack_params_mcmc(self, mcmc, include_galaxy):
         # and now the great unpacking.
         pps = {'galparams': {}}
-        medians = {k: np.median(val) for k, val in mcmc.get_samples().items()}
+        # (band dependant sites are vectors, one median per band)
+        medians = {k: np.median(val, axis=0) for k, val in mcmc.get_samples().items()}
 
         pps['positions'] = [medians[k] for k in ('x1', 'y1', 'x2', 'y2')]
 
-        for band in self.bands:
-            pps[band] = [medians[k] for k in (f'A1_{band}', f'A2_{band}')]
-            pps[f'offsets_{band}'] = [medians[k] for k in (f'dx_{band}', f'dy_{band}')]
+        pps['A'] = np.stack([medians['A1'], medians['A2']])
+        pps['offsets'] = np.stack([medians['dx'], medians['dy']], axis=1)
 
         if include_galaxy:
-            for band in self.bands:
-                pps['galparams'][f'I_e_{band}'] = medians[f'I_e_{band}']
+            pps['galparams']['I_e'] = medians['I_e']
             pps['galparams']['positions'] = [medians[k] for k in ('xg', 'yg')]
             pps['galparams']['morphology'] = [medians[k] for k in ('r_e', 'n', 'ellip', 'theta')]
             # store the medians
@@ -535,7 +668,7 @@ class DoublyLensedQuasarFitter:
             i0 = axs[i, 0].imshow(data[i], origin='lower')
             i1 = axs[i, 1].imshow(mod[i], origin='lower')
             i2 = axs[i, 2].imshow(res[i], origin='lower')
-            dx, dy = params[f'offsets_{band}']
+            dx, dy = np.asarray(params['offsets'])[i]
 
             for j, (im, title) in enumerate(zip([i0, i1, i2], ['data', 'model', 'norm. res.'])):
                 divider = make_axes_locatable(axs[i, j])
@@ -560,17 +693,19 @@ class DoublyLensedQuasarFitter:
 
         fig, axs = plt.subplots(1, 3, figsize=(6, 2))
 
-        cdata = np.moveaxis(self.data, 0, 2)
+        band_indexes = list(band_indexes)
+        cdata = self.data[band_indexes]
         scale = np.nanpercentile(cdata, 99.5)
-        i0 = axs[0].imshow(cdata / scale, origin='lower')
-
-        mod = modelfunc(params)
-        mod = np.moveaxis(mod, 0, 2)
-        i1 = axs[1].imshow(mod / scale, origin='lower')
-        res = (cdata - mod) / np.moveaxis(self.noisemap, 0, 2)
+        mod = np.asarray(modelfunc(params))[band_indexes]
+        res = (cdata - mod) / self.noisemap[band_indexes]
         res -= np.nanmin(res)
         res /= np.nanmax(np.abs(res))
-        i2 = axs[2].imshow(res, origin='lower')
+
+        # a single transposition to the (y, x, color) layout of imshow, for the three panels at once.
+        panels = np.ascontiguousarray(np.moveaxis(np.stack([cdata / scale, mod / scale, res]), 1, 3))
+        i0 = axs[0].imshow(panels[0], origin='lower')
+        i1 = axs[1].imshow(panels[1], origin='lower')
+        i2 = axs[2].imshow(panels[2], origin='lower')
 
         for j, (im, ax, title) in enumerate(zip([i0, i1, i2], axs, ['data', 'model', 'norm. res.'])):
             ax.set_title(title)
@@ -647,34 +782,24 @@ class DoublyLensedQuasarFitter:
 
         # prepare the sersic params:
         xg, yg = params['galparams']['positions']
-        xgs = jnp.array([xg + params[f'offsets_{band}'][0] for band in self.bands])
-        ygs = jnp.array([yg + params[f'offsets_{band}'][1] for band in self.bands])
-        I_es = jnp.array([params['galparams'][f'I_e_{band}'] for band in self.bands])
+        offsets = jnp.asarray(params['offsets'])
+        xgs = xg + offsets[:, 0]
+        ygs = yg + offsets[:, 1]
+        I_es = jnp.asarray(params['galparams']['I_e'])
         r_e, n, ellip, theta = params['galparams']['morphology']
         # we'll have to produce one model per band, vectorize
         vecsersic = vmap(
             lambda x, y, ie, psf: self.elliptical_sersic_profile_convolved(ie, r_e, x, y, n, ellip, theta, psf),
             in_axes=(0, 0, 0, 0)
         )
-        psfs = jnp.array([self.translate_and_scale_psf(-0.5, -0.5, 1., self.psf[i]) for i in range(len(self.bands))])
+        psfs = self.sersic_psfs
         sersics = vecsersic(xgs, ygs, I_es, psfs)
         fluxes = np.array([np.sum(sersics[i]) for i in range(len(self.bands))])
         magnitudes = -2.5 * np.log10(self.scale * fluxes)
         return magnitudes
 
     def get_ps_SEDs(self, params):
-        x1, y1, x2, y2 = params['positions']
-
-        A1s = jnp.array([params[band][0] for band in self.bands])
-        A2s = jnp.array([params[band][1] for band in self.bands])
-
-        xs1 = jnp.array([x1 + params[f'offsets_{band}'][0] for band in self.bands])
-        ys1 = jnp.array([y1 + params[f'offsets_{band}'][1] for band in self.bands])
-        xs2 = jnp.array([x2 + params[f'offsets_{band}'][0] for band in self.bands])
-        ys2 = jnp.array([y2 + params[f'offsets_{band}'][1] for band in self.bands])
-        vecpsf = vmap(lambda x, y, a, psf: self.translate_and_scale_psf(x, y, a, psf), in_axes=(0, 0, 0, 0))
-        p1 = vecpsf(xs1, ys1, A1s, self.psf)
-        p2 = vecpsf(xs2, ys2, A2s, self.psf)
+        p1, p2 = self.point_sources(params)
         fluxes1 = np.array([np.sum(p1[i]) for i in range(len(self.bands))])
         fluxes2 = np.array([np.sum(p2[i]) for i in range(len(self.bands))])
         mags1 = -2.5 * np.log10(self.scale * fluxes1)
@@ -765,6 +890,11 @@ class DoublyLensedQuasarFitter:
                     else:
                         attributes[key] = value[0]
 
+        # files written before the band dependant parameters were stacked have one entry per band instead:
+        for key in cls._param_attributes:
+            if attributes.get(key) is not None:
+                attributes[key] = cls.stack_legacy_params(attributes[key], attributes['bands'])
+
         # convert any ndarray attributes that were list back to their original type, cuz we can.
         pnogalaxy = attributes["param_mediansampler_no_galaxy"]
         attributes["param_mediansampler_no_galaxy"] = cls.convert_arrays_to_lists(pnogalaxy)
@@ -781,6 +911,27 @@ class DoublyLensedQuasarFitter:
 
         return new_instance
 
+    @staticmethod
+    def stack_legacy_params(params, bands):
+        """
+        converts a dictionary of parameters of the old layout, with one entry per band
+        ({band: (A1, A2), f'offsets_{band}': (dx, dy), 'galparams': {f'I_e_{band}': I_e, ...}, ...}),
+        into the stacked layout described in `model_no_galaxy`. Parameters already stacked are returned as they are.
+        :param params: dictionary of parameters
+        :param bands: list of the band names, in the order of the model.
+        :return: dictionary of parameters, stacked.
+        """
+        if 'A' in params or not bands or f'offsets_{bands[0]}' not in params:
+            return params
+        stacked = {key: value for key, value in params.items() if key not in bands and not key.startswith('offsets_')}
+        stacked['A'] = np.array([params[band] for band in bands], dtype=float).T
+        stacked['offsets'] = np.array([params[f'offsets_{band}'] for band in bands], dtype=float)
+        galparams = params.get('galparams', {})
+        if f'I_e_{bands[0]}' in galparams:
+            stacked['galparams'] = {key: value for key, value in galparams.items() if not key.startswith('I_e_')}
+            stacked['galparams']['I_e'] = np.array([galparams[f'I_e_{band}'] for band in bands], dtype=float)
+        return stacked
+
     def resize_other_model(self, other_model, pixel_size, other_pixel_size, roughalign=True):
         """
 
@@ -888,19 +1039,15 @@ if __name__ == "__main__":
     ff = '/scratch/diff_img_paper/survey_data_and_modelling/PSJ0557-2959/legacysurvey/cutouts_legacysurvey_J0557-2959_cutouts.h5'
     modelm = prepare_fitter_from_h5(ff)
 
+    # bands g, r, i, z
     modelm.param_mediansampler_with_galaxy = {'galparams': {'positions': [0, 0], 'morphology': [1.0710126, 1., 0.0, 0.],
-                                                            'I_e_g': 0.5, 'I_e_i': .1,
-                                                            'I_e_r': 2.0, 'I_e_z': 5.0},
-                                              'positions': [0., 1., 0., 1.], 'g': [0., 0.],
-                                              'offsets_g': [0.0, 0.0], 'i': [1., 1.],
-                                              'offsets_i': [0.0, 0.0], 'r': [1., 1.],
-                                              'offsets_r': [0.0, 0.0], 'z': [1., 1.],
-                                              'offsets_z': [0.0, 0.0]}
-    modelm.param_mediansampler_no_galaxy = {'positions': [0., 1., 0., 0.], 'g': [1., 1.],
-                                            'offsets_g': [0.0, 0.0], 'i': [1., 1.],
-                                            'offsets_i': [0.0, 0.0], 'r': [1., 1.],
-                                            'offsets_r': [0.0, 0.0], 'z': [1., 1.],
-                                            'offsets_z': [0.0, 0.0]}
+                                                            'I_e': [0.5, 2.0, .1, 5.0]},
+                                              'positions': [0., 1., 0., 1.],
+                                              'A': [[0., 1., 1., 1.], [0., 1., 1., 1.]],
+                                              'offsets': [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.0]]}
+    modelm.param_mediansampler_no_galaxy = {'positions': [0., 1., 0., 0.],
+                                            'A': [[1., 1., 1., 1.], [1., 1., 1., 1.]],
+                                            'offsets': [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.0]]}
 
     # out = modelm.sample(num_warmup=1000, num_samples=500, position_scale=15.0, include_galaxy=False)
     # print(modelm.param_mediansampler_with_galaxy)
@@ -56,13 +56,18 @@ def update_hdf5(filename, path, data):
 
     yeah I know, long ass docstring, but I never remember how to handle hdf5 files.
 
-    :param filename: path or string, path to our hdf5 file.
+    :param filename: path or string, path to our hdf5 file. Can also be an h5py.File already open for writing,
+                     to avoid opening and closing the file for each of many updates.
     :param path: path inside the hdf5 path to update
     :param data: the data (numpy array) to be saved under this path.
     :return: None
 
     """
-    with h5py.File(filename, 'a') as f:
+    if isinstance(filename, h5py.File):
+        f = filename
         if path in f:
             del f[path]
         f[path] = data
+        return
+    with h5py.File(filename, 'a') as f:
+        update_hdf5(f, path, data)
@@ -2,9 +2,15 @@
  Collection of helpers to get a nice PSF for the field of a lens in a given survey and filter.
 """
 import numpy as np
+import h5py
 from pathlib import Path
+import json
+from collections import defaultdict
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import multiprocessing
 import matplotlib.pyplot as plt
-import io
 
 from starred.psf.psf import PSF
 from starred.psf.loss import Loss
@@ -24,35 +30,76 @@ from lensedquasarsurveyor.io import save_dict_to_hdf5, update_hdf5, load_dict_fr
 from lensedquasarsurveyor.plots import plot_psf
 
 
+@functools.lru_cache(maxsize=32)
 def create_round_mask(size, radius):
-    # create a grid of indices
-    x, y = np.indices((size, size))
+    # coordinates with respect to the center, of the rows and columns.
+    # Their squares broadcast into the grid of squared distances, no need for the square root :
+    # True outside of the circle, False inside.
+    # We always ask for the same few masks, so they are cached, and read-only as they are shared: copy to modify.
+    offsets = np.arange(size) - (size - 1) / 2
+    mask = offsets[:, np.newaxis]**2 + offsets[np.newaxis, :]**2 > radius**2
+    mask.flags.writeable = False
+    return mask
 
-    center = (size - 1) / 2
 
-    distance = np.sqrt((x - center)**2 + (y - center)**2)
-
-    arr = np.full((size, size), True)
-    arr[distance <= radius] = False
-
-    return arr
+def _rasterize_loss(loss_history, size=256):
+    """
+    Draws the loss history as a bright line on a black size x size uint8 image, in the [x, y] convention of f2n
+    (y going up), for the tile of `plot_psf`. Much cheaper than rendering a matplotlib figure and reading it back.
+    """
+    image = np.zeros((size, size), dtype=np.uint8)
+    loss = np.asarray(loss_history, dtype=float).ravel()
+    loss = loss[np.isfinite(loss)]
+    if loss.size == 0:
+        print('no loss history to plot')
+        return image
+    # resample the curve with several points per column, then draw each segment between consecutive points
+    # as a vertical bar in its column so that the steep parts of the curve stay connected.
+    samples = np.interp(np.linspace(0, loss.size - 1, 4 * size), np.arange(loss.size), loss)
+    span = np.ptp(samples)
+    ys = (samples - samples.min()) / span * (size - 1) if span > 0 else np.zeros_like(samples)
+    ys = ys.round().astype(int)
+    xs = np.linspace(0, size - 1, samples.size).round().astype(int)
+    low, high = np.full(size, size), np.full(size, -1)
+    np.minimum.at(low, xs[:-1], np.minimum(ys[:-1], ys[1:]))
+    np.maximum.at(high, xs[:-1], np.maximum(ys[:-1], ys[1:]))
+    yy = np.arange(size)
+    image[(yy >= low[:, np.newaxis]) & (yy <= high[:, np.newaxis])] = 255
+    return image
+
+
+def _estimate_psf_task(stars, noisemaps, masks, upsampling_factor):
+    """
+    One fit of `estimate_psf_from_extracted_h5`, at the module level so that it can be sent to a worker process.
+    Returns what `estimate_psf` returns, or the RuntimeError it raised.
+    """
+    try:
+        return estimate_psf(stars, noisemaps, masks, upsampling_factor=upsampling_factor, debug=False)
+    except RuntimeError as E:
+        return E
 
 
-def estimate_psf_from_extracted_h5(h5filepath, upsampling_factor=2, redo=False, verbose=False):
+def estimate_psf_from_extracted_h5(h5filepath, upsampling_factor=2, redo=False, verbose=False, n_jobs=1):
     """
     Here we'll open the file created with `download_and_extract`, and
     for each band
         for each image
              estimate the PSF and store it in the same hdf5 file.
 
+    The fits are independent, so with n_jobs > 1 they run in that many worker processes. The workers are spawned
+    (jax does not survive a fork), so a script calling this with n_jobs > 1 needs an `if __name__ == "__main__":` guard.
+    The hdf5 file is only ever written by the main process, in the order of the bands and images.
+
     :param h5filepath: string or Path, path to our cutouts.
     :param upsampling_factor: int, how many times smaller should the PSF pixels be.
     :param redo: bool, default False. Whether to estimate the PSF if it already is in h5filepath.
     :param verbose: bool, default False.
+    :param n_jobs: int, default 1. Number of PSF fits to run concurrently.
     :return: None
     """
 
     dic = load_dict_from_hdf5(h5filepath)
+    tasks = []
     for band, banddata in dic['stars'].items():
         if not redo and band in dic and 'psf' in dic[band]['0']:
             print(f'PSF already estimated for band {band}')
@@ -65,96 +112,105 @@ def estimate_psf_from_extracted_h5(h5filepath, upsampling_factor=2, redo=False,
                 print(f"PSF for band {band}, image {imageindex} using {len(stars)} cutouts of size {hsize} pixels.")
                 print(f"Our upsampling factor is {upsampling_factor}.")
             masks = create_round_mask(hsize, 0.5*hsize)  # yeaaaaaaah I don't want to deal with masking yet.
-            masks = np.repeat(masks[np.newaxis, ...], stars.shape[0], axis=0)
-            try:
-                # we overwrite stars and sigma_2 because the routine might have eliminated some of them.
-                narrowpsf, fullmodel, stars, sigma_2, loss_history = estimate_psf(stars, noisemaps**2, masks,
-                                                                                  upsampling_factor=upsampling_factor,
-                                                                                  debug=False)
-                noisemaps = sigma_2**0.5
-
-                # store the estimated PSF in the hdf5 file.
-                update_hdf5(h5filepath, f"{band}/{imageindex}/psf", narrowpsf)
-                update_hdf5(h5filepath, f"{band}/{imageindex}/psf_supersampling_factor",
-                            np.array([upsampling_factor], dtype=int))
-
-            except RuntimeError as E:
-                print(E)
+            masks = np.broadcast_to(masks, stars.shape)  # same mask for all the stars, a view.
+            tasks.append((band, imageindex, stars, noisemaps, masks))
+
+    with ExitStack() as stack:
+        if n_jobs > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context('spawn')
+            executor = ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks)), mp_context=context)
+            # on the way out (also on failure), the fits not started yet are cancelled.
+            stack.callback(executor.shutdown, cancel_futures=True)
+            futures = [executor.submit(_estimate_psf_task, stars, noisemaps, masks, upsampling_factor)
+                       for _, _, stars, noisemaps, masks in tasks]
+            # collected one by one in the loop below: should one fit fail, those before it are still stored,
+            # as in the sequential case.
+            results = (future.result() for future in futures)
+        else:
+            # one fit at a time, each one stored and plotted before the next one starts.
+            results = (_estimate_psf_task(stars, noisemaps, masks, upsampling_factor)
+                       for _, _, stars, noisemaps, masks in tasks)
+
+        # one handle for all the writes, only this process writes to the file.
+        h5file = stack.enter_context(h5py.File(h5filepath, 'a'))
+        for (band, imageindex, _, _, _), result in zip(tasks, results):
+            if isinstance(result, RuntimeError):
+                # nothing to store or plot for this one.
+                print(result)
+                continue
+            # we overwrite stars and sigma_2 because the routine might have eliminated some of them.
+            narrowpsf, fullmodel, stars, sigma_2, loss_history = result
+            noisemaps = sigma_2**0.5
+
+            # store the estimated PSF in the hdf5 file.
+            update_hdf5(h5file, f"{band}/{imageindex}/psf", narrowpsf)
+            update_hdf5(h5file, f"{band}/{imageindex}/psf_supersampling_factor",
+                        np.array([upsampling_factor], dtype=int))
+            # so that the PSFs already estimated are on disk should the next fit crash.
+            h5file.flush()
 
             ############################################################################################################
             # plot!
             identifier = f"{band}_{imageindex}"
             residuals = (stars - fullmodel) / noisemaps
-            # ok, here we make the plot of the loss history.
-            try:
-                # try because the analytical methods don't have a 'loss_history'
-                # field.
-                fig = plt.figure(figsize=(2.56, 2.56))
-                plt.plot(loss_history)
-                plt.title('loss history')
-                plt.tight_layout()
-                with io.BytesIO() as buff:
-                    # write the plot to a buffer, read it with numpy
-                    fig.savefig(buff, format='raw')
-                    buff.seek(0)
-                    plotimg = np.frombuffer(buff.getvalue(), dtype=np.uint8)
-                    w, h = fig.canvas.get_width_height()
-                    # white <-> black:
-                    lossim = 255 - plotimg.reshape((int(h), int(w), -1))[:, :, 0].T[:, ::-1]
-                plt.close()
-            except:
-                print('no loss history in extra_fields')
-                lossim = np.zeros((256, 256))
+            # the loss history, drawn straight into a thumbnail:
+            lossim = _rasterize_loss(loss_history)
             plot_psf(identifier, noisemaps, stars, residuals, narrowpsf, lossim, workdir=Path(h5filepath).parent)
             ############################################################################################################
 
 
-def estimate_psf(stars, sigma_2, masks, upsampling_factor=2, debug=False):
+def estimate_psf(stars, noisemaps, masks, upsampling_factor=2, debug=False, noise_propagation='SLIT',
+                 convolution_method='fft', max_iterations=1500, min_iterations=None, stop_at_loss_increase=False):
     """
     Final step once we have the data, the right stars and their cutouts and noise maps, and potentially masks.
 
     :param stars:  3D array, shape (N, nx, ny) where N is the number of star cutouts, and nx, ny the cutout dimensions
-    :param sigma_2: same as `stars`, but for the noisemap (squared).
+    :param noisemaps: same as `stars`, but for the noisemap (sigma, not squared).
     :param masks: same as `stars` if applicable, masks to apply to the field. default: None
     :param upsampling_factor: int, pixel size of PSF model / pixel size of image. Default: 2
     :param debug: bool, shows some plots of the stars before they are swallowed by the starred machinery.
-    :return: 2D numpy array of the PSF of the field, model of the given stars with the obtained PSF, loss history
+    :param noise_propagation: string, default 'SLIT'. How the noise is propagated to the starlet scales to weight
+                              the regularization: 'SLIT' does it analytically (a single pass), 'MC' with 100 noise
+                              realizations.
+    :param convolution_method: string, default 'fft'. Convolution method of the STARRED PSF model, one of 'fft',
+                               'scipy' or 'lax' (direct convolution, can be faster for very small cutouts).
+    :param max_iterations: int, default 1500. Maximum number of iterations of the second (adabelief) fit, of the
+                           background. The first fit, of the moffat, is an L-BFGS-B that stops by itself once converged.
+    :param min_iterations: int, default None. With stop_at_loss_increase, number of iterations done in any case.
+    :param stop_at_loss_increase: bool, default False. Stop the second fit early, as soon as the loss goes up again.
+                                  Saves most of the iterations on stars that are already well fitted.
+    :return: 2D numpy array of the PSF of the field, model of the given stars with the obtained PSF, the stars and
+             squared noisemaps that were kept, loss history
     """
     # let's scale our data!
     scale = np.nanpercentile(stars, 99.9)
-    stars /= scale
-    sigma_2 /= scale**2
-
-    # filter images with no data
-    stars_filtered, noise2_filtered, mask_filtered = [], [], []
-    for i in range(stars.shape[0]):
-        star, noise2, mask = stars[i], sigma_2[i], masks[i]
-        if np.nanstd(star) < 1e-10 or np.isnan(np.nanstd(star)):
-            # yeaaah probably no data in here
-            continue
-        stars_filtered.append(star)
-        noise2_filtered.append(noise2)
-        mask_filtered.append(mask)
 
-    if not stars_filtered:
+    # filter images with no data: flat, or all nans (their nanstd and range are nan).
+    # The float32 rounding of the std can leave a flat cutout a tiny non-zero nanstd: they are also tested exactly.
+    flat = np.nanmax(stars, axis=(1, 2)) == np.nanmin(stars, axis=(1, 2))
+    keep = (np.nanstd(stars, axis=(1, 2)) >= 1e-10 * scale) & ~flat
+    if not keep.any():
         # no data in here!
         raise RuntimeError("No data!!!")
-    stars = np.array(stars_filtered)
-    sigma_2 = np.array(noise2_filtered)
-
-    # also, filter out nans...
-    max_real_value = np.nanmax(sigma_2[sigma_2 != np.inf])
-    replacement_value = 10 * max_real_value
-    sigma_2[np.isnan(sigma_2)] = replacement_value
-    stars[np.isnan(stars)] = 0.
-    # and infs ...
-    sigma_2[np.isinf(sigma_2)] = replacement_value
-    stars[np.isinf(stars)] = 0.
+    # the boolean indexing copies, the scaling can then be done in place without touching the arrays of the caller.
+    # float32 is plenty for our cutouts, and halves the memory traffic of the whole fit.
+    stars = stars[keep].astype(np.float32, copy=False)
+    stars /= scale
+    sigma_2 = noisemaps[keep].astype(np.float32, copy=False)
+    sigma_2 /= scale
+    sigma_2 *= sigma_2
+    masks = masks[keep]
+
+    # also, filter out nans and infs ...
+    bad = ~np.isfinite(sigma_2)
+    replacement_value = 10 * np.max(sigma_2[~bad])
+    sigma_2[bad] = replacement_value
+    stars[~np.isfinite(stars)] = 0.
 
     # and negative values!!
     # find a typical low positive value
     typical_low = np.nanpercentile(sigma_2[sigma_2 > 0.], 0.5)
-    sigma_2[sigma_2 < typical_low] = typical_low
+    np.maximum(sigma_2, typical_low, out=sigma_2)
     if debug:
         fig, axs = plt.subplots(2, stars.shape[0])
         for i in range(stars.shape[0]):
@@ -166,8 +222,8 @@ def estimate_psf(stars, sigma_2, masks, upsampling_factor=2, debug=False):
                 axs[1].imshow(sigma_2[i])
         plt.show()
 
-    # save a copy of noise:
-    noise_for_W = np.sqrt(sigma_2.copy())
+    # the noise (sigma) for the regularization weights. np.sqrt returns a new array, no need to copy sigma_2:
+    noise_for_W = np.sqrt(sigma_2)
 
     N = stars.shape[0]
     image_size = stars[0].shape[0]
@@ -178,7 +234,7 @@ def estimate_psf(stars, sigma_2, masks, upsampling_factor=2, debug=False):
 
     model = PSF(image_size=image_size, number_of_sources=N,
                 upsampling_factor=upsampling_factor,
-                convolution_method='fft', include_moffat=True)
+                convolution_method=convolution_method, include_moffat=True)
 
     # Parameter initialization
     kwargs_init, kwargs_fixed, kwargs_up, kwargs_down = model.smart_guess(stars, fixed_background=True)
@@ -208,7 +264,7 @@ def estimate_psf(stars, sigma_2, masks, upsampling_factor=2, debug=False):
     kwargs_partial = parameters.args2kwargs(best_fit)
 
     W = propagate_noise(model, noise_for_W, kwargs_partial,
-                        wavelet_type_list=['starlet'], method='MC',
+                        wavelet_type_list=['starlet'], method=noise_propagation,
                         num_samples=100,
                         seed=1, likelihood_type='chi2', verbose=False,
                         upsampling_factor=upsampling_factor)[0]
@@ -231,9 +287,9 @@ def estimate_psf(stars, sigma_2, masks, upsampling_factor=2, debug=False):
 
     optim = Optimizer(loss, parameters, method='adabelief')
     best_fit, logL_best_fit, extra_fields, runtime = optim.minimize(
-        max_iterations=1500, min_iterations=None,
+        max_iterations=max_iterations, min_iterations=min_iterations,
         init_learning_rate=1e-3, schedule_learning_rate=True,
-        restart_from_init=True, stop_at_loss_increase=False,
+        restart_from_init=True, stop_at_loss_increase=stop_at_loss_increase,
         progress_bar=True, return_param_history=True
     )
 
@@ -254,6 +310,7 @@ def download_and_extract(ra, dec, workdir, survey='legacysurvey', mag_estimate=N
     This is a procedure, more than an atomic function. We do the following:
      - query the region around ra, dec for gaia detections, looking for stars we can use to model the PSF
      - if nothing useful, query a bigger region
+       (the stars found are kept in a json file in workdir, reused when called again with the same search parameters)
      - download the data from the survey provided as an argument
      - extract cutouts of the lens (assumed to be at the provided ra,dec) and of the PSF stars
      - saves the cutouts to a file, returns both the path to the downloaded fits file and to the cutouts.
@@ -295,21 +352,36 @@ def download_and_extract(ra, dec, workdir, survey='legacysurvey', mag_estimate=N
         return savepath_fits, savepath_cutouts
 
     # ok, now we can proceed.
-    # downloading the images
-    # try first with a "small" field (100 arcsec)
-    fieldsize = initial_search_box
-    score, goodstars = get_similar_stars(ra, dec, fieldsize/2, mag_estimate=mag_estimate, verbose=verbose,
-                                         toobright=limit_bright_mag_psfstar)
-    # if not, try making it bigger:
-    while score < min_score_psfstars and fieldsize < 250:
+    # the gaia queries are slow: we keep their outcome as a json file next to the data, and reuse it if we come back
+    # with the same search parameters.
+    gaiacache = workdir / f"gaia_psfstars_{get_J2000_name(ra, dec)}.json"
+    search = {'ra': float(ra), 'dec': float(dec),
+              'mag_estimate': None if mag_estimate is None else float(mag_estimate),
+              'toobright': float(limit_bright_mag_psfstar), 'min_score': float(min_score_psfstars),
+              'initial_search_box': float(initial_search_box)}
+    cached = json.loads(gaiacache.read_text()) if gaiacache.exists() else {}
+    if cached.get('search') == search:
         if verbose:
-            print(f'Making field bigger to find PSF stars: {fieldsize:.0f} arcseconds.')
-        fieldsize *= 1.2
+            print('Reusing the PSF stars found earlier, from', gaiacache)
+        fieldsize, goodstars = cached['fieldsize'], tuple(cached['goodstars'])
+    else:
+        # downloading the images
+        # try first with a "small" field (100 arcsec)
+        fieldsize = initial_search_box
         score, goodstars = get_similar_stars(ra, dec, fieldsize/2, mag_estimate=mag_estimate, verbose=verbose,
                                              toobright=limit_bright_mag_psfstar)
-    # at this point, if still nothing we give up ...
-    if len(goodstars[0]) < 1:
-        raise RuntimeError(f"Really cannot find stars around {(ra, dec)} ...")
+        # if not, try making it bigger:
+        while score < min_score_psfstars and fieldsize < 250:
+            if verbose:
+                print(f'Making field bigger to find PSF stars: {fieldsize:.0f} arcseconds.')
+            fieldsize *= 1.2
+            score, goodstars = get_similar_stars(ra, dec, fieldsize/2, mag_estimate=mag_estimate, verbose=verbose,
+                                                 toobright=limit_bright_mag_psfstar)
+        # at this point, if still nothing we give up ...
+        if len(goodstars[0]) < 1:
+            raise RuntimeError(f"Really cannot find stars around {(ra, dec)} ...")
+        goodstars = tuple([float(coord) for coord in coords] for coords in goodstars)
+        gaiacache.write_text(json.dumps({'search': search, 'fieldsize': fieldsize, 'goodstars': goodstars}))
 
     savepath_fits = get_cutouts_file(ra, dec, fieldsize, downloaddir=workdir, survey=survey,
                                      filename=savepath_fits.name, verbose=verbose)
@@ -327,81 +399,31 @@ def download_and_extract(ra, dec, workdir, survey='legacysurvey', mag_estimate=N
     # (star for each image, noisemap for each image)
     # we need to transform that into
     # {'band1': { 'image1': {'band1': np.array(star1,star2,...), np.array(noisemap1,noisemap2...)} ...}
-    transformed_cutoutslens = {}
+    transformed_cutoutslens = defaultdict(dict)
 
-    # first, the lens
+    # first, the lens. Here we are doing the lens, not stars! so we expect one cutout per image:
+    # our arrays are (Nx, Ny) directly.
     for band, (array1, array2, wcs_headers) in cutoutslens.items():
-        image_count = array1.shape[0]
-
-        if band not in transformed_cutoutslens:
-            transformed_cutoutslens[band] = {}
-
-        for i in range(image_count):
-            key = str(i)
-            data = array1[i]
-            noise = array2[i]
-            wcs_header = wcs_headers[i]
-            if key not in transformed_cutoutslens[band]:
-                transformed_cutoutslens[band][key] = {}
+        for i in range(array1.shape[0]):
+            transformed_cutoutslens[band][str(i)] = {'data': array1[i],
+                                                     'noise': array2[i],
+                                                     'wcs_header': np.array([wcs_headers[i]], dtype='S')}
 
-            if 'data' not in transformed_cutoutslens[band][key]:
-                transformed_cutoutslens[band][key]['data'] = [data]
-            else:
-                transformed_cutoutslens[band][key]['data'].append(data)
-            if 'noise' not in transformed_cutoutslens[band][key]:
-                transformed_cutoutslens[band][key]['noise'] = [noise]
-            else:
-                transformed_cutoutslens[band][key]['noise'].append(noise)
-            if 'wcs_header' not in transformed_cutoutslens[band][key]:
-                transformed_cutoutslens[band][key]['wcs_header'] = [wcs_header]
-            else:
-                transformed_cutoutslens[band][key]['wcs_header'].append(wcs_header)
-
-    # once this is done, go back through each band, image and type of data to
-    # make them numpy arrays
-    for band, banddata in transformed_cutoutslens.items():
-        for imageindex, objects in banddata.items():
-            for key, array in objects.items():
-                if key == 'wcs_header':
-                    objects[key] = np.array(array, dtype='S')
-                else:
-                    # but here we are doing the lens, not stars! so we expect one cutout per image.
-                    # our shape will be (1, Nx, Ny), let's make it (Nx,Ny).
-                    objects[key] = np.array(array[0])
-
-    # next, the stars.
-    transformed_cutouts = {}
+    # next, the stars: one list of cutouts per band and image, stacked once they're all there.
+    transformed_cutouts = defaultdict(lambda: defaultdict(lambda: {'stars': [], 'noise': []}))
 
     for star, bands in cutouts.items():
         # discard wcs:
         for band, (array1, array2, _) in bands.items():
-            image_count = array1.shape[0]
-
-            if band not in transformed_cutouts:
-                transformed_cutouts[band] = {}
-
-            for i in range(image_count):
-                key = str(i)
-                star = array1[i]
-                noise = array2[i]
-                if key not in transformed_cutouts[band]:
-                    transformed_cutouts[band][key] = {}
-
-                if 'stars' not in transformed_cutouts[band][key]:
-                    transformed_cutouts[band][key]['stars'] = [star]
-                else:
-                    transformed_cutouts[band][key]['stars'].append(star)
-                if 'noise' not in transformed_cutouts[band][key]:
-                    transformed_cutouts[band][key]['noise'] = [noise]
-                else:
-                    transformed_cutouts[band][key]['noise'].append(noise)
-
-    # once this is done, go back through each band, image and type of data to
-    # make them numpy arrays ...sigh
+            for i in range(array1.shape[0]):
+                objects = transformed_cutouts[band][str(i)]
+                objects['stars'].append(array1[i])
+                objects['noise'].append(array2[i])
+
     for band, banddata in transformed_cutouts.items():
         for imageindex, objects in banddata.items():
             for key, array in objects.items():
-                objects[key] = np.array(array)
+                objects[key] = np.stack(array)
 
     # amazing, let's save it!
     # return transformed_cutouts
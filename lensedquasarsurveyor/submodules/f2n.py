@@ -1,14 +1,21 @@
 #! /usr/bin/env python
 
 import os
+import math
+import functools
+import operator
 import numpy as np
 from PIL import Image as im
-from PIL import ImageOps as imop
 from PIL import ImageDraw as imdw
+from PIL import ImageFont as imft
 import astropy.io.fits as ft
 
 
 class f2nimage:
+
+    # PIL's default font, shared by all images, see getfont()
+    _defaultfont = None
+
     def __init__(self, numpyarray=None, shape=(100, 100), fill=10000.0, verbose=True):
         """
         Give me a numpyarray, or give me a shape (in this case I build my own array and fill it with the value fill).
@@ -34,14 +41,14 @@ class f2nimage:
         # The draw object is created when needed, see makedraw()
         self.draw = None
 
-        # The fonts are loaded when needed, see loadtitlefont()
+        # You can set your own fonts here. If None, the default font is used, see getfont()
         self.titlefont = None
         self.labelfont = None
         self.infofont = None
 
         # Now the numpy array to hold the actual data.
 
-        if np.any(numpyarray) is None:
+        if numpyarray is None:
 
             self.numpyarray = np.ones(shape, dtype=np.float32)*fill
 
@@ -54,7 +61,13 @@ class f2nimage:
 
                 raise RuntimeError("Your array must be 2D.")
 
-            self.numpyarray = numpyarray.astype(np.float32)
+            # We keep the pixel types that we can directly work with (like those of most FITS images), anything else
+            # is converted to float32. The statistics and the scaling promote small chunks to float32 when needed.
+            # No copy if the array is already a contiguous one :
+            if numpyarray.dtype in (np.float32, np.float16, np.int16, np.uint16, np.int32):
+                self.numpyarray = np.ascontiguousarray(numpyarray)
+            else:
+                self.numpyarray = np.ascontiguousarray(numpyarray, dtype=np.float32)
 
         # We keep trace of any crops through these :
         self.xa = 0
@@ -67,6 +80,36 @@ class f2nimage:
         # coordinates in the orinigal numpy array or fits image, and coordinates in the
         # rebinned cutout etc.
 
+    @classmethod
+    def from_fits(cls, infile, hdu=0, memmap=True, verbose=True):
+        """
+        Reads a FITS file and returns a f2nimage object.
+        Use hdu to specify which HDU you want (primary = 0)
+        With memmap, the pixels are read from the memory mapped file directly into our own array :
+        the file is not first loaded into RAM and then copied.
+        This is not possible for scaled data (e.g. unsigned integers, with BZERO), which astropy loads in RAM.
+        """
+        if memmap:
+            hdr = ft.getheader(infile, hdu)
+            memmap = not any(key in hdr for key in ("BZERO", "BSCALE", "BLANK"))
+
+        with ft.open(infile, memmap=memmap) as hdulist:
+            hdr = hdulist[hdu].header
+            data = np.asarray(hdulist[hdu].data)
+            # A single pass from the FITS data (big endian, [y, x]) to our C-ordered [x, y] array in native byte
+            # order : otherwise every later operation would stream through reversed strides and byteswap on the fly.
+            pixelarray = np.empty(data.shape[::-1], dtype=data.dtype.newbyteorder("="))
+            np.copyto(pixelarray, data.transpose())
+
+            pixelarrayshape = pixelarray.shape
+            if verbose:
+                print(("Input shape : (%i, %i)" % (pixelarrayshape[0], pixelarrayshape[1])))
+                print(("Input file BITPIX : %s" % (hdr["BITPIX"])))
+            if verbose:
+                print(("Internal array type :", pixelarray.dtype.name))
+
+            return cls(pixelarray, verbose=verbose)
+
     def __str__(self):
         """
         Returns a string with some info about the image.
@@ -128,36 +171,40 @@ class f2nimage:
             if border > 0:
                 if self.verbose :
                     print(("For the stats I will leave a border of %i pixels" % border))
-                calcarray = self.numpyarray[border:-border, border:-border].copy()
+                calcarray = self.numpyarray[border:-border, border:-border]
             else:
-                calcarray = self.numpyarray.copy()
+                calcarray = self.numpyarray
         else:
-            calcarray = self.numpyarray.copy()
+            calcarray = self.numpyarray
             if self.verbose:
                 print(("Image is too small for a border of %i" % (border)))
-        calcarray.shape = calcarray.size  # We flatten the 2D array
-
-        # Now we handle an eventual saturation so that it does not fool the code :
-        if satlevel > 0:
-            calcarray = calcarray[calcarray < satlevel]  # we simply skip pixels higher than satlevel...
+        # No copy of the image here : calcarray is a view, we only ever read from it.
 
         # Starting with the simple possibilities :
+        if z1 == "ex" or z2 == "ex":
+            # Now we handle an eventual saturation so that it does not fool the code :
+            # we simply skip pixels higher than satlevel... by masking them out of the reductions, so that the other
+            # pixels are not copied. The extrema are still those of the full image, not of a sample.
+            exmask = calcarray < satlevel if satlevel > 0 else True
+            exinfo = np.finfo(calcarray.dtype) if calcarray.dtype.kind == "f" else np.iinfo(calcarray.dtype)
+
         if z1 == "ex":
-            self.z1 = np.min(calcarray)
+            # float, as integer cutoffs could overflow in the scalings
+            self.z1 = float(np.min(calcarray, where=exmask, initial=exinfo.max))
             if self.verbose:
                 print(("Setting ex z1 to %f" % self.z1))
 
         if z2 == "ex":
-            self.z2 = np.max(calcarray)
+            self.z2 = float(np.max(calcarray, where=exmask, initial=exinfo.min))
             if self.verbose:
                 print(("Setting ex z2 to %f" % self.z2))
 
-        if type(z1) == type(0) or type(z1) == type(0.0):
+        if isinstance(z1, (int, float)):
             self.z1 = z1
             if self.verbose:
                 print(("Setting z1 to %f" % self.z1))
 
-        if type(z2) == type(0) or type(z2) == type(0.0):
+        if isinstance(z2, (int, float)):
             self.z2 = z2
             if self.verbose:
                 print(("Setting z2 to %f" % self.z2))
@@ -165,22 +212,33 @@ class f2nimage:
         # Now it gets a little more sophisticated.
         if z1 == "auto" or z2 == "auto" or z1 == "flat" or z2 == "flat":
             # To speed up, we do not want to do statistics on the full image if it is large.
-            # So we prepare a small random sample of pixels.
-            calcarray.shape = calcarray.size  # We flatten the 2D array
-            if calcarray.size > samplesizelimit:
-                selectionindices = np.linspace(0, calcarray.size-1, samplesizelimit).astype(int)
-                statsel = calcarray[selectionindices]
+            # So we prepare a small sample of evenly spaced pixels.
+            # The stride is rounded up, so that the sample never exceeds samplesizelimit pixels while still covering
+            # the full image (truncating a longer sample would only keep its first rows).
+            stride = max(1, -(-calcarray.size // samplesizelimit))
+            if calcarray.flags.c_contiguous:
+                statsel = calcarray.ravel()[::stride]  # this is a view
             else:
-                statsel = calcarray
-
-            medianlevel = np.median(statsel)
+                # The border-trimmed array is not contiguous, and ravel() would copy all of it.
+                # So we directly pick the pixels of the sample instead :
+                rows, cols = np.divmod(np.arange(0, calcarray.size, stride), calcarray.shape[1])
+                statsel = calcarray[rows, cols]
+            statsel = statsel.astype(np.float32, copy=False)
+            # NaNs (and infs) would spoil the medians and quantiles : out of the sample, that is cheap to copy.
+            statsel = statsel[np.isfinite(statsel)]
+
+            # Now we handle an eventual saturation so that it does not fool the code.
+            # This is done on the small sample, not on the full image :
+            if satlevel > 0:
+                statsel = statsel[statsel < satlevel]  # we simply skip pixels higher than satlevel...
+
+            medianlevel = _fastmedian(statsel)
             firststd = np.std(statsel)
 
             if z1 == "auto":
                 # 2 sigma clipping (quick and dirty star removal) :
-                nearskypixvals = statsel[np.logical_and(statsel > medianlevel - 2*firststd,
-                                                        statsel < medianlevel + 2*firststd)]
-                skylevel = np.median(nearskypixvals)
+                nearskypixvals = statsel[(statsel > medianlevel - 2*firststd) & (statsel < medianlevel + 2*firststd)]
+                skylevel = _fastmedian(nearskypixvals)
                 secondstd = np.std(nearskypixvals)
                 if self.verbose:
                     print(("Sky level at %f +/- %f" % (skylevel, secondstd)))
@@ -191,32 +249,29 @@ class f2nimage:
 
             if z2 == "auto":
                 # Here we want to reject a percentage of high values...
-                self.z2 = np.nanpercentile(statsel, 99.95)
+                # (np.percentile only partially sorts the finite sample to get this single quantile)
+                if statsel.size == 0:
+                    # nothing left (all NaN or saturated) : NaN, corrected below, as np.nanpercentile would give.
+                    self.z2 = np.nan
+                else:
+                    self.z2 = np.percentile(statsel, 99.95)
                 if self.verbose:
                     print(("Setting auto z2 to %f" % self.z2))
 
-            if z1 == "flat":
-
-                # 5 sigma clipping to get rid of cosmics :
-                nearflatpixvals = statsel[np.logical_and(statsel > medianlevel - 5*firststd,
-                                                         statsel < medianlevel + 5*firststd)]
+            if z1 == "flat" or z2 == "flat":
+                # 5 sigma clipping to get rid of cosmics, done once for both cutoffs :
+                nearflatpixvals = statsel[(statsel > medianlevel - 5*firststd) & (statsel < medianlevel + 5*firststd)]
 
-                flatlevel = np.median(nearflatpixvals)
+                flatlevel = _fastmedian(nearflatpixvals)
                 flatstd = np.std(nearflatpixvals)
 
+            if z1 == "flat":
                 self.z1 = flatlevel - nsig*flatstd
 
                 if self.verbose:
                     print(("Setting flat z1 : %f, nsig = %i" % (self.z1, nsig)))
 
             if z2 == "flat":
-                # 5 sigma clipping to get rid of cosmics :
-                nearflatpixvals = statsel[np.logical_and(statsel > medianlevel - 5*firststd,
-                                                         statsel < medianlevel + 5*firststd)]
-
-                flatlevel = np.median(nearflatpixvals)
-                flatstd = np.std(nearflatpixvals)
-
                 self.z2 = flatlevel + nsig*flatstd
 
                 if self.verbose:
@@ -292,7 +347,7 @@ class f2nimage:
         if self.pilimage is not None:
             raise RuntimeError("Cannot rebin anymore, PIL image already exists !")
 
-        if type(factor) != type(0):
+        if not isinstance(factor, int):
             raise RuntimeError("Rebin factor must be an integer !")
 
         if factor < 1:
@@ -309,14 +364,15 @@ class f2nimage:
                 print(("Rebinning %ix%i : I do not need to crop" % (factor, factor)))
 
         if method == "mean":
-            self.numpyarray = rebin(self.numpyarray, neededshape/factor)  # we call the rebin function defined below
+            # we call the rebin function defined below, float32 is plenty for the rendering
+            self.numpyarray = rebin(self.numpyarray, neededshape//factor, dtype=np.float32)
         elif method == "max":
             if self.verbose:
                 print("submodules - Getting the MAX out of your images !")
-            self.numpyarray = remax(self.numpyarray, neededshape/factor)
+            self.numpyarray = remax(self.numpyarray, neededshape//factor)
         else:
             raise RuntimeError("Unknown rebin method %s" % method)
-        # The integer division neededshape/factor is ok, we checked for this above.
+        # The integer division neededshape//factor is ok, we checked for this above.
         self.binfactor = int(self.binfactor * factor)
 
     def makepilimage(self, scale="log", negative=False):
@@ -327,34 +383,30 @@ class f2nimage:
         If you choose scale = "clog" or "clin", you get hue values (aka rainbow colours).
         """
 
-        calcarray = self.numpyarray.transpose()
+        # We flip it so that (0, 0) is back in the bottom left corner as in ds9
+        # We do this here, so that you can write on the image from left to right :-)
+        # This is only a view : the flip is done for free when the blocks are copied, see _grayblocks.
+        calcarray = self.numpyarray.transpose()[::-1]
 
         if scale == "log" or scale == "lin":
             self.negative = negative
 
-            calcarray = calcarray.clip(min=self.z1, max=self.z2)
-
-            if scale == "log":
-                calcarray = loggray(calcarray, self.z1, self.z2)
-            else:
+            grayscale = loggray if scale == "log" else lingray
 
-                calcarray = lingray(calcarray, self.z1, self.z2)
+            # The gray levels are rounded directly into the uint8 output, block after block :
+            bwarray = np.empty(calcarray.shape, dtype=np.uint8)
+            for (start, stop, block) in _grayblocks(calcarray, self.z1, self.z2, grayscale):
+                np.rint(block, out=bwarray[start:stop], casting="unsafe")
 
-            bwarray = np.zeros(calcarray.shape)
-            calcarray.round(out=bwarray)
-            bwarray = bwarray.astype(np.uint8)  # and you get the dtype you want in the end
             if negative:
                 if self.verbose:
                     print("Using negative scale")
-                bwarray = 255 - bwarray
+                np.subtract(255, bwarray, out=bwarray)
 
             if self.verbose:
                 print(("PIL range : [%i, %i]" % (np.min(bwarray), np.max(bwarray))))
 
-            # We flip it so that (0, 0) is back in the bottom left corner as in ds9
-            # We do this here, so that you can write on the image from left to right :-)
-
-            self.pilimage = imop.flip(im.fromarray(bwarray))
+            self.pilimage = im.fromarray(bwarray)
             if self.verbose:
                 print(("PIL image made with scale : %s" % scale))
             return 0
@@ -362,16 +414,20 @@ class f2nimage:
         if scale == "clog" or scale == "clin":  # Rainbow !
 
             self.negative = False
-            if scale == "clin":
-                calcarray = (calcarray.clip(min=self.z1, max=self.z2)-self.z1)/(self.z2 - self.z1)  # 0 to 1
-            if scale == "clog":
-                calcarray = 10.+990.*(calcarray.clip(min=self.z1, max=self.z2)-self.z1)/(self.z2-self.z1)  # 10 to 1000
-                calcarray = (np.log10(calcarray)-1.0)*0.5  # 0 to 1
 
-            (rarray, garray, barray) = rainbow(calcarray, autoscale=False)
-            carray = np.dstack((rarray, garray, barray))
+            grayscale = loggray if scale == "clog" else lingray
 
-            self.pilimage = imop.flip(im.fromarray(carray, "RGB"))
+            # We quantize the gray levels on the levels of the rainbow lookup table, and the colours are a gather :
+            lut = rainbowlut()
+            carray = np.empty(calcarray.shape + (3,), dtype=np.uint8)
+            for (start, stop, block) in _grayblocks(calcarray, self.z1, self.z2, grayscale):
+                # NaN pixels would be out of the table : they get the colour of the lowest level.
+                np.nan_to_num(block, copy=False, nan=0.0)
+                np.multiply(block, (lut.shape[0] - 1) / 255.0, out=block)
+                np.rint(block, out=block)
+                np.take(lut, block.astype(np.intp), axis=0, out=carray[start:stop])
+
+            self.pilimage = im.fromarray(carray, "RGB")
             if self.verbose:
                 print(("PIL image made with scale : %s" % scale))
             return 0
@@ -386,34 +442,21 @@ class f2nimage:
         By default, colour is gray, to avoid switching to RGB.
         But if you give for instance (255, 0, 0), I will do the switch.
         """
-        self.checkforpilimage()
-        self.changecolourmode(colour)
-        self.makedraw()
+        # We switch self to RGB if needed :
+        colour = self._prepare_draw(colour)
 
         # Checking size of maskarray :
         if maskarray.shape[0] != self.pilimage.size[0] or maskarray.shape[1] != self.pilimage.size[1]:
             raise RuntimeError("Mask and image must have the same size !")
 
-        # We make an "L" mode image out of the mask :
-        tmparray = np.zeros(maskarray.shape, dtype=np.uint8)
-        tmparray[maskarray] = 255
-        maskpil = imop.flip(im.fromarray(tmparray.transpose()))
-
-        # We make a plain colour image :
-        if type(colour) == type(0):
-            plainpil = im.new("L", self.pilimage.size, colour)
-        else:
-            plainpil = im.new("RGB", self.pilimage.size, colour)
-
-        # We switch self to RGB if needed :
-        self.changecolourmode(colour)
+        # We make an "L" mode image out of the mask, flipped like in makepilimage.
+        # This is a single pass, writing 0 or 255 directly into a contiguous uint8 array :
+        tmparray = np.empty((maskarray.shape[1], maskarray.shape[0]), dtype=np.uint8)
+        np.multiply(maskarray.transpose()[::-1], np.uint8(255), out=tmparray)
+        maskpil = im.fromarray(tmparray)
 
-        # And now use the function composite to "blend" our image with the plain colour image :
-
-        self.pilimage = im.composite(plainpil, self.pilimage, maskpil)
-
-        # As we have changed the image object, we have to rebuild the draw object :
-        self.draw = None
+        # And paste the plain colour through this mask, directly into our image :
+        self.pilimage.paste(colour, mask=maskpil)
 
     def showcutoffs(self, redblue=False):
         """
@@ -441,6 +484,18 @@ class f2nimage:
         if self.pilimage is None:
             raise RuntimeError("No PIL image : call makepilimage first !")
 
+    @classmethod
+    def getfont(cls, font=None):
+        """Auxiliary method to choose the font to write with.
+        Returns font if you give one, otherwise PIL's default font. The latter is loaded only once, and then shared
+        by all images (PIL would otherwise reload it for every new draw object).
+        """
+        if font is not None:
+            return font
+        if cls._defaultfont is None:
+            cls._defaultfont = imft.load_default()
+        return cls._defaultfont
+
     def makedraw(self):
         """Auxiliary method to make a draw object if not yet done.
         This is also called by changecolourmode, when we go from L to RGB, to get a new draw object.
@@ -467,7 +522,7 @@ class f2nimage:
                 else:
                     return (255, 255, 255)
         else:
-            if self.pilimage.mode == "RGB" and type(colour) == type(0):
+            if self.pilimage.mode == "RGB" and isinstance(colour, int):
                 return colour, colour, colour
             else:
                 return colour
@@ -477,13 +532,24 @@ class f2nimage:
         Give me a colour (either an int, or a 3-tuple, values 0 to 255) and I decide if the image mode has to
         be switched from "L" to "RGB".
         """
-        if type(newcolour) != type(0) and self.pilimage.mode != "RGB":
+        if not isinstance(newcolour, int) and self.pilimage.mode != "RGB":
             if self.verbose:
                 print("Switching to RGB !")
             self.pilimage = self.pilimage.convert("RGB")
             self.draw = None  # important, we have to bebuild the draw object.
             self.makedraw()
 
+    def _prepare_draw(self, colour):
+        """Auxiliary method called before drawing : resolves the colour (see defaultcolour), switches
+        the image to RGB if this colour requires it, and makes the draw object.
+        Returns the resolved colour.
+        """
+        self.checkforpilimage()
+        colour = self.defaultcolour(colour)
+        self.changecolourmode(colour)
+        self.makedraw()
+        return colour
+
     def upsample(self, factor):
         """
         The inverse operation of rebin, applied on the PIL image.
@@ -515,6 +581,17 @@ class f2nimage:
 
         return (pilx, pily)
 
+    def pilcoords_vec(self, xs, ys):
+        """
+        Same as pilcoords, but for arrays of coordinates : converts them all at once.
+        Returns the arrays (pilxs, pilys).
+        """
+        scale = float(self.upsamplefactor) / float(self.binfactor)
+        pilxs = ((np.asarray(xs) - 1 - self.xa) * scale).astype(np.int32)
+        pilys = ((self.yb - np.asarray(ys)) * scale).astype(np.int32)
+
+        return (pilxs, pilys)
+
     def pilscale(self, r):
         """
         Converts a "scale" (like an aperture radius) of the original array or FITS file to the current PIL coordinates.
@@ -526,10 +603,7 @@ class f2nimage:
         Most elementary drawing, single pixel, used mainly for testing purposes.
         Coordinates are those of your initial image !
         """
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         (pilx, pily) = self.pilcoords((x, y))
 
@@ -542,20 +616,25 @@ class f2nimage:
         I will convert this into the right PIL coordiates.
         """
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         (pilx, pily) = self.pilcoords((x, y))
         pilr = self.pilscale(r)
 
+        self._draw_circle_fast(pilx, pily, pilr, colour, label)
+
+    def _draw_circle_fast(self, pilx, pily, pilr, colour, label=None):
+        """
+        The drawing part of drawcircle, for coordinates that are already in PIL coordinates and a colour
+        already resolved by _prepare_draw. Nothing is checked here, this is meant for loops over many stars.
+        """
         self.draw.ellipse([(pilx-pilr+1, pily-pilr+1), (pilx+pilr+1, pily+pilr+1)], outline=colour)
 
         if label is not None:
             # Then we write it :
             textwidth = 5
-            self.draw.text((pilx - float(textwidth)/2.0 + 2, pily + pilr + 4), label, fill=colour, font=self.labelfont)
+            self.draw.text((pilx - float(textwidth)/2.0 + 2, pily + pilr + 4), label, fill=colour,
+                           font=self.getfont(self.labelfont))
 
     def drawrectangle(self, xa, xb, ya, yb, colour=None, label=None):
         """
@@ -563,10 +642,7 @@ class f2nimage:
 
         """
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         (pilxa, pilya) = self.pilcoords((xa, ya))
         (pilxb, pilyb) = self.pilcoords((xb, yb))
@@ -576,7 +652,7 @@ class f2nimage:
         if label is not None:
             textwidth = 5
             self.draw.text(((pilxa + pilxb)/2.0 - float(textwidth)/2.0 + 1, pilya + 2), label,
-                           fill=colour, font=self.labelfont)
+                           fill=colour, font=self.getfont(self.labelfont))
 
     def drawline(self, x=None, y=None, l=10, t=0.0, width=None, colour=None):
         """
@@ -594,10 +670,7 @@ class f2nimage:
         if y is None:
             y = self.origheight/2.0
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         ax = x - 0.5*l*np.cos(t) + 1
         ay = y - 0.5*l*np.sin(t)
@@ -618,10 +691,7 @@ class f2nimage:
         We write a title, centered below the image.
         """
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         imgwidth = self.pilimage.size[0]
         imgheight = self.pilimage.size[1]
@@ -629,7 +699,7 @@ class f2nimage:
         textxpos = imgwidth/2.0 - textwidth/2.0
         textypos = imgheight - 30
 
-        self.draw.text((textxpos, textypos), titlestring, fill=colour, font=self.titlefont)
+        self.draw.text((textxpos, textypos), titlestring, fill=colour, font=self.getfont(self.titlefont))
 
         if self.verbose:
             print("I've written a title on the image.")
@@ -640,14 +710,11 @@ class f2nimage:
         Provide linelist, a list of strings that will be written one below the other.
         """
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colour)
-        self.changecolourmode(colour)
-        self.makedraw()
+        colour = self._prepare_draw(colour)
 
         for i, line in enumerate(linelist):
             topspacing = 5 + (12 + 5)*i
-            self.draw.text((10, topspacing), line, fill=colour, font=self.infofont)
+            self.draw.text((10, topspacing), line, fill=colour, font=self.getfont(self.infofont))
 
         if self.verbose:
             print("I've written some info on the image.")
@@ -659,6 +726,8 @@ class f2nimage:
             - dictionnaries, with fields "name", "x", and "y"
             - objects with attributes name, x, and y --> use this if you work with the star.py module.
         In both cases, you can optinnally also provide "r" and "colour" for each star.
+        starlist can also be a numpy structured array with fields "name", "x", and "y" (and optionnally "r",
+        "colour"), as read by drawstarfile. This is the fastest option for large catalogs.
 
         :param autocolour: name of a key or attribute to use to determine colour (e.g., 'flux', 'fwhm')
         ... Individual colours are disregarded in this case.
@@ -671,39 +740,51 @@ class f2nimage:
                 print("No stars to draw !")
             return
 
+        # We extract all the fields in one pass each, and then convert the positions to PIL coordinates all at once.
+        if isinstance(starlist, np.ndarray) and starlist.dtype.names is not None:
+            # Structured arrays are read column by column, without looping over the stars :
+            def column(key, default):
+                if key in starlist.dtype.names:
+                    return starlist[key].tolist()
+                return [default] * len(starlist)
+            (xs, ys, names) = (starlist["x"], starlist["y"], starlist["name"].tolist())
+        else:
+            # Otherwise we dispatch once on the type of the stars, the mandatory fields are taken by C-level getters :
+            if type(starlist[0]) is dict:
+                getter = operator.itemgetter
+
+                def column(key, default):
+                    return [star.get(key, default) for star in starlist]
+            else:
+                getter = operator.attrgetter
+
+                def column(key, default):
+                    return [getattr(star, key, default) for star in starlist]
+            (xs, ys, names) = zip(*map(getter("x", "y", "name"), starlist))
+        rs = column("r", r)
+
         if autocolour is not None and len(starlist) >= 2:
-            colours = []
-            for star in starlist:
-                if type(star) is dict:
-                    colours.append(star.get(autocolour, 0.0))
-                else:
-                    colours.append(getattr(star, autocolour, 0.0))
-            colours = np.array(colours)
-            colours = loggray(colours)
+            colours = loggray(np.array(column(autocolour, 0.0)))
 
             (rarray, garray, barray) = rainbow(colours, autoscale=True)
             colours = np.dstack((rarray, garray, barray))[0]
 
         else:
-            colours = []
-            for star in starlist:
-                if type(star) is dict:
-                    colours.append(star.get("colour", colour))
-                else:
-                    colours.append(getattr(star, "colour", colour))
+            colours = column("colour", colour)
 
-        self.checkforpilimage()
-        colour = self.defaultcolour(colours[0])
-        self.changecolourmode(colour)
-        self.makedraw()
+        colours = [None if c is None else tuple(c) for c in colours]
 
-        for (star, c) in zip(starlist, colours):
-            if c is not None:
-                c = tuple(c)
-            if type(star) is dict:
-                self.drawcircle(star["x"], star["y"], r=star.get("r", r), colour=c, label=star["name"])
-            else:
-                self.drawcircle(star.x, star.y, getattr(star, "r", r), colour=c, label=star.name)
+        # The colour mode can only change once, from L to RGB. We do this switch (if needed) before the loop,
+        # so that the colours can be resolved once and the circles drawn without any further checks :
+        self._prepare_draw(next((c for c in colours if c is not None), None))
+        colours = [self.defaultcolour(c) for c in colours]
+
+        (pilxs, pilys) = self.pilcoords_vec(np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64))
+        pilrs = self.pilscale(np.array(rs, dtype=np.float64))
+
+        # Only the drawing itself remains in the loop, PIL has no way to draw many ellipses at once :
+        for (pilx, pily, pilr, name, c) in zip(pilxs.tolist(), pilys.tolist(), pilrs.tolist(), names, colours):
+            self._draw_circle_fast(pilx, pily, pilr, c, name)
 
         if self.verbose:
             print(("I've drawn %i stars." % len(starlist)))
@@ -722,32 +803,22 @@ class f2nimage:
             print("Line format to write : name x y [other stuff ...]")
             raise RuntimeError("Cannot read star catalog.")
 
-        catfile = open(filename, "r")
-        lines = catfile.readlines()
-        catfile.close()
-
-        dictlist = []  # We will append dicts here.
-        for i, line in enumerate(lines):
-            if line[0] == '#' or len(line) < 4:
-                continue
-            elements = line.split()
-            nbelements = len(elements)
-            if nbelements < 3:
-                print(("Format error on line", i+1, "of :"))
-                print(filename)
-                print("We want : name x y [other stuff ...]")
-                raise RuntimeError("Cannot read star catalog.")
-
-            name = elements[0]
-            x = float(elements[1])
-            y = float(elements[2])
-            dictlist.append({"name": name, "x": x, "y": y})
+        # The parsing is done by numpy, we get a structured array that drawstarlist can directly use :
+        try:
+            stararray = np.loadtxt(filename, dtype=[("name", object), ("x", np.float64), ("y", np.float64)],
+                                   usecols=(0, 1, 2), comments="#", encoding="utf-8", ndmin=1)
+        except ValueError as e:
+            print("Format error in :")
+            print(filename)
+            print(e)
+            print("We want : name x y [other stuff ...]")
+            raise RuntimeError("Cannot read star catalog.")
 
         if self.verbose:
-            print("I've read %i stars from :")
+            print(("I've read %i stars from :" % len(stararray)))
             print((os.path.split(filename)[1]))
 
-        self.drawstarlist(dictlist, r=r, colour=colour)
+        self.drawstarlist(stararray, r=r, colour=colour)
 
     def tonet(self, outfile):
         """
@@ -762,36 +833,89 @@ class f2nimage:
         self.pilimage.save(outfile, "PNG")
 
 
-def lingray(x, a=None, b=None):
+def lingray(x, a=None, b=None, out=None):
     """
     Auxiliary function that specifies the linear gray scale.
     a and b are the cutoffs : if not specified, min and max are used
+    If you give me an out array (can be x itself), I write the result in there, otherwise in a new float32 array.
+    No temporary arrays are made.
     """
     if a is None:
         a = np.min(x)
     if b is None:
         b = np.max(x)
 
-    return 255.0 * (x-float(a))/(b-a)
+    if out is None:
+        # float32 is plenty for gray levels, and halves the memory traffic of the steps below :
+        out = np.empty(np.shape(x), dtype=np.float32)
 
+    np.subtract(x, float(a), out=out)
+    # numpy division: equal cutoffs only warn (NaN gray levels), as they always did, instead of raising.
+    np.multiply(out, np.divide(255.0, b - a), out=out)
+    return out
 
-def loggray(x, a=None, b=None):
+
+def loggray(x, a=None, b=None, out=None):
     """
     Auxiliary function that specifies the logarithmic gray scale.
     a and b are the cutoffs : if not specified, min and max are used
+    If you give me an out array (can be x itself), I write the result in there, otherwise in a new float32 array.
+    No temporary arrays are made.
     """
     if a is None:
         a = np.min(x)
     if b is None:
         b = np.max(x)
 
-    linval = 10.0 + 990.0 * (x-float(a))/(b-a)
-    return (np.log10(linval)-1.0)*0.5 * 255.0
+    if out is None:
+        # float32 is plenty for gray levels, and halves the memory traffic of the steps below :
+        out = np.empty(np.shape(x), dtype=np.float32)
+
+    np.subtract(x, float(a), out=out)
+    np.multiply(out, np.divide(990.0, b - a), out=out)
+    np.add(out, 10.0, out=out)
+    np.log10(out, out=out)
+    np.subtract(out, 1.0, out=out)
+    np.multiply(out, 0.5 * 255.0, out=out)
+    return out
 
 
-def rainbow(data, autoscale=False):
+def _fastmedian(a):
+    """
+    Auxiliary function, the median of a 1D array with a partial sort instead of a full one.
+    Used on the samples of setzscale. As np.median, this gives NaN for an empty array.
+    """
+    n = a.size
+    if n == 0:
+        return np.nan
+    if n % 2 == 1:
+        return np.partition(a, n//2)[n//2]
+    return 0.5 * np.sum(np.partition(a, [n//2 - 1, n//2])[n//2 - 1:n//2 + 1])
+
+
+def _grayblocks(calcarray, z1, z2, grayscale, blockpixels=65536):
+    """
+    Auxiliary generator for makepilimage, going through calcarray in blocks of rows.
+    For each block, yields (start, stop, block) where block holds the gray levels (0 to 255) of the rows start:stop,
+    computed by grayscale (lingray or loggray) between the cutoffs z1 and z2.
+    All blocks are computed in place in the same small float32 buffer, that stays in the cache :
+    no full size temporary is ever made, even for huge images.
+    """
+    blockrows = max(1, blockpixels // max(1, calcarray.shape[1]))
+    buffer = np.empty((min(blockrows, calcarray.shape[0]), calcarray.shape[1]), dtype=np.float32)
+    for start in range(0, calcarray.shape[0], blockrows):
+        stop = min(start + blockrows, calcarray.shape[0])
+        block = buffer[:stop - start]
+        np.copyto(block, calcarray[start:stop], casting="unsafe")
+        np.clip(block, z1, z2, out=block)
+        grayscale(block, z1, z2, out=block)
+        yield (start, stop, block)
+
+
+def rainbow(data, autoscale=False, blockpixels=65536):
     """
     Give me array-like intensities/fluxes/whatever, I return uint8 arrays of red, green, blue.
+    These are views on the channels of the single interleaved array made by _rainbowrgb.
 
     :param data: the data. Should be between 0.0 and 1.0, otherwise, use autoscale
     :type data: array
@@ -799,121 +923,101 @@ def rainbow(data, autoscale=False):
     :param autoscale: I rescale the data to be between 0.0 and 1.0
     :type autoscale: boolean
 
-    Algorithm for HSV to RGB from http://www.cs.rit.edu/~ncs/color/t_convert.html, by Eugene Vishnevsky
-    Same stuff then for submodules in C
+    HSV to RGB is done with the branchless formulation : for each channel, k = (n + h/60) mod 6, with n = 5, 3, 1
+    for red, green, blue, and the channel value is v - v*s*clip(min(k, 4-k), 0, 1).
+    Here s = v = 1, so this is a single pass per channel instead of six sector masks.
+    The pixels go through this in blocks of blockpixels, like in _grayblocks : the float32 temporaries
+    are small buffers that stay in the cache, only the uint8 outputs have the full size.
 
     h is from 0 to 360 (hue)
     s from 0 to 1 (saturation)
     v from 0 to 1 (brightness)
     """
+    rgbarray = _rainbowrgb(data, autoscale=autoscale, blockpixels=blockpixels)
+    return (rgbarray[..., 0], rgbarray[..., 1], rgbarray[..., 2])
+
 
+def _rainbowrgb(data, autoscale=False, blockpixels=65536):
+    """
+    Does the work of rainbow, but returns the colours as one interleaved uint8 array of shape data.shape + (3,),
+    that is the layout PIL wants for RGB images. The channels are rounded straight into it, block by block.
+    """
+    data = np.asarray(data)
+    flatdata = data.reshape(-1)
     if autoscale:
-        calcarray = (data - np.min(data)) / (np.max(data) - np.min(data))
-    else:
-        calcarray = data.copy()
-
-    calcarray = (1.0-calcarray) * 300.0  # I limit this to not go into red again
-    # The order of colours is Violet < Blue < Green < Yellow < Red
-
-    # We prepare the output arrays
-    rcalcarray = np.ones(calcarray.shape)
-    gcalcarray = np.ones(calcarray.shape)
-    bcalcarray = np.ones(calcarray.shape)
-
-    h = calcarray/60.0  # sector 0 to 5
-    i = np.floor(h).astype(int)
-
-    v = 1.0 * np.ones(calcarray.shape)
-    s = 1.0 * np.ones(calcarray.shape)
-
-    f = h - i  # factorial part of h, this is an array
-    p = v * ( 1.0 - s )
-    q = v * ( 1.0 - s * f )
-    t = v * ( 1.0 - s * ( 1.0 - f ) )
-
-    # sector 0:
-    indices = (i == 0)
-    rcalcarray[indices] = 255.0 * v[indices]
-    gcalcarray[indices] = 255.0 * t[indices]
-    bcalcarray[indices] = 255.0 * p[indices]
-
-    # sector 1:
-    indices = (i == 1)
-    rcalcarray[indices] = 255.0 * q[indices]
-    gcalcarray[indices] = 255.0 * v[indices]
-    bcalcarray[indices] = 255.0 * p[indices]
-
-    # sector 2:
-    indices = (i == 2)
-    rcalcarray[indices] = 255.0 * p[indices]
-    gcalcarray[indices] = 255.0 * v[indices]
-    bcalcarray[indices] = 255.0 * t[indices]
-
-    # sector 3:
-    indices = (i == 3)
-    rcalcarray[indices] = 255.0 * p[indices]
-    gcalcarray[indices] = 255.0 * q[indices]
-    bcalcarray[indices] = 255.0 * v[indices]
-
-    # sector 4:
-    indices = (i == 4)
-    rcalcarray[indices] = 255.0 * t[indices]
-    gcalcarray[indices] = 255.0 * p[indices]
-    bcalcarray[indices] = 255.0 * v[indices]
-
-    # sector 5:
-    indices = (i == 5)
-    rcalcarray[indices] = 255.0 * v[indices]
-    gcalcarray[indices] = 255.0 * p[indices]
-    bcalcarray[indices] = 255.0 * q[indices]
-
-    rarray = np.zeros(calcarray.shape, dtype=np.uint8)
-    garray = np.zeros(calcarray.shape, dtype=np.uint8)
-    barray = np.zeros(calcarray.shape, dtype=np.uint8)
-    rcalcarray.round(out=rarray)
-    gcalcarray.round(out=garray)
-    bcalcarray.round(out=barray)
-
-    return (rarray, garray, barray)
+        # calcarray = (data - min) / (max - min), folded into the computation of h
+        datamin = np.min(data)
+        factor = -5.0 / (np.max(data) - datamin)
+
+    rgbarray = np.empty(data.shape + (3,), dtype=np.uint8)
+    flatrgb = rgbarray.reshape(-1, 3)
+    flatouts = (flatrgb[:, 0], flatrgb[:, 1], flatrgb[:, 2])
+
+    blockpixels = max(1, min(blockpixels, flatdata.size))
+    (hbuffer, kbuffer, kkbuffer) = [np.empty(blockpixels, dtype=np.float32) for _ in range(3)]
+    for start in range(0, flatdata.size, blockpixels):
+        stop = min(start + blockpixels, flatdata.size)
+        (h, k, kk) = (hbuffer[:stop - start], kbuffer[:stop - start], kkbuffer[:stop - start])
+        # h = (1.0-calcarray) * 5.0, sector 0 to 5, I limit this to not go into red again.
+        if autoscale:
+            np.subtract(flatdata[start:stop], datamin, out=h, casting="same_kind")
+            np.multiply(h, factor, out=h)
+            np.add(h, 5.0, out=h)
+        else:
+            np.subtract(1.0, flatdata[start:stop], out=h, casting="same_kind")
+            np.multiply(h, 5.0, out=h)
+        # The order of colours is Violet < Blue < Green < Yellow < Red
+        np.clip(h, 0.0, 5.0, out=h)
+
+        for (n, flatout) in zip((5.0, 3.0, 1.0), flatouts):
+            np.add(h, n, out=k)
+            np.mod(k, 6.0, out=k)
+            np.subtract(4.0, k, out=kk)
+            np.minimum(k, kk, out=k)
+            np.clip(k, 0.0, 1.0, out=k)
+            np.multiply(k, -255.0, out=k)
+            np.add(k, 255.0, out=k)
+            np.rint(k, out=flatout[start:stop], casting="unsafe")
+
+    return rgbarray
+
+
+@functools.lru_cache(maxsize=None)
+def rainbowlut(size=1024):
+    """
+    The rainbow colours of size evenly spaced levels between 0.0 and 1.0, as a (size, 3) uint8 array.
+    This is computed once, and then used as a lookup table by makepilimage. Do not modify it !
+    """
+    lut = _rainbowrgb(np.linspace(0.0, 1.0, size))
+    lut.flags.writeable = False
+    return lut
 
 
 def fromfits(infile, hdu=0, verbose=True):
     """
     Factory function that reads a FITS file and returns a f2nimage object.
     Use hdu to specify which HDU you want (primary = 0)
+    Same as f2nimage.from_fits, kept for compatibility.
     """
+    return f2nimage.from_fits(infile, hdu=hdu, verbose=verbose)
 
-    pixelarray, hdr = ft.getdata(infile, hdu, header=True)
-    pixelarray = np.asarray(pixelarray).transpose()
-
-    pixelarrayshape = pixelarray.shape
-    if verbose:
-        print(("Input shape : (%i, %i)" % (pixelarrayshape[0], pixelarrayshape[1])))
-        print(("Input file BITPIX : %s" % (hdr["BITPIX"])))
-    if verbose:
-        print(("Internal array type :", pixelarray.dtype.name))
 
-    return f2nimage(pixelarray, verbose=verbose)
-
-
-def rebin(a, newshape):
+def rebin(a, newshape, dtype=None):
     """
     Auxiliary function to rebin ndarray data.
     Source : http://www.scipy.org/Cookbook/Rebinning
         example usage:
      a=rand(6,4); b=rebin(a,(3,2))
+    Each bin is a block of the reshaped array, so the mean is a single numpy reduction.
+    dtype is that of the result : by default, the floating type of a (at least float32), so no precision is lost.
     """
+    if dtype is None:
+        dtype = np.result_type(a, np.float32)
+    if tuple(newshape) == a.shape:
+        return a.astype(dtype)
 
-    shape = np.shape(a)
-
-    lenShape = len(shape)
-
-    evList = ['a.reshape('] + \
-             ['int(newshape[%d]),int(factor[%d]),' % (i, i) for i in range(lenShape)] + \
-             [')'] + ['.sum(%d)' % (i+1) for i in range(lenShape)] + \
-             ['/int(factor[%d])' % i for i in range(lenShape)]
-
-    return eval(''.join(evList))
+    (blocks, binaxes) = _binblocks(a, newshape)
+    return blocks.mean(axis=binaxes, dtype=dtype)
 
 
 def remax(a, newshape):
@@ -921,18 +1025,22 @@ def remax(a, newshape):
     Aux function to "rebin" an array but always keeping the maximum pixel value of each
     bin instead of the mean !
     """
+    if tuple(newshape) == a.shape:
+        return a.copy()
 
-    shape = a.shape
-
-    lenShape = len(shape)
-
-    factor = np.asarray(shape)/np.asarray(newshape)
+    (blocks, binaxes) = _binblocks(a, newshape)
+    return blocks.max(axis=binaxes)
 
-    evList = ['a.reshape('] + \
-             ['int(newshape[%d]),int(factor[%d]),' % (i, i) for i in range(lenShape)] + \
-             [')'] + ['.max(%d)' % (i+1) for i in range(lenShape)]
 
-    return eval(''.join(evList))
+def _binblocks(a, newshape):
+    """
+    Reshapes the array a of shape (h, w, ...) into (newshape[0], h/newshape[0], newshape[1], w/newshape[1], ...),
+    and returns this view together with the axes (1, 3, ...) that run over the pixels of each bin.
+    """
+    blockshape = []
+    for (n, length) in zip(newshape, a.shape):
+        blockshape.extend((int(n), length // int(n)))
+    return a.reshape(blockshape), tuple(range(1, 2 * a.ndim, 2))
 
 
 def compose(f2nimages, outfile):
@@ -950,20 +1058,22 @@ def compose(f2nimages, outfile):
 
     """
     # We start by doing some checks, and try to print out helpfull error messages.
-    verbosity = []
-    colourmodes = []
+    # (the lines can have different numbers of images, so we keep one list of (width, height) per line)
+    sizes = []
+    colours = set()
+    verbose = False
     for i, line in enumerate(f2nimages):
         for j, img in enumerate(line):
             if img.verbose:
                 print(("Checking line %i, image %i (verbose)..." % (i+1, j+1)))
             img.checkforpilimage()
-            verbosity.append(img.verbose)
-            colourmodes.append(img.pilimage.mode)
-    verbose = np.any(np.array(verbosity))
-    colours = list(set(colourmodes))
+            verbose = verbose or img.verbose
+            colours.add(img.pilimage.mode)
+        sizes.append([img.pilimage.size for img in line])
+    colours = list(colours)
 
     # We check if the widths are compatible :
-    widths = [np.sum(np.array([img.pilimage.size[0] for img in line])) for line in f2nimages]
+    widths = [sum(width for (width, height) in line) for line in sizes]
     if len(set(widths)) != 1:
         print("Total widths of the lines :")
         print(widths)
@@ -971,14 +1081,14 @@ def compose(f2nimages, outfile):
     totwidth = widths[0]
 
     # Similar for the heights :
-    for i, line in enumerate(f2nimages):
-        heights = [img.pilimage.size[1] for img in line]
+    for i, line in enumerate(sizes):
+        heights = [height for (width, height) in line]
         if len(set(heights)) != 1:
             print(("Heights of the images in line %i :" % (i + 1)))
             print(heights)
             raise RuntimeError("Heights of the images in line %i are not compatible." % (i + 1))
 
-    totheight = np.sum(np.array([line[0].pilimage.size[1] for line in f2nimages]))
+    totheight = sum(line[0][1] for line in sizes)
     # Ok, now it should be safe to go for the composition :
     if verbose:
         print(("Composition size : %i x %i" % (totwidth, totheight)))
@@ -988,20 +1098,26 @@ def compose(f2nimages, outfile):
     if len(colours) == 1 and colours[0] == "L":
         if verbose:
             print("Builing graylevel composition")
-        compoimg = im.new("L", (totwidth, totheight), 128)
+        mode = "L"
+        compoarray = np.empty((totheight, totwidth), dtype=np.uint8)
     else:
         if verbose:
             print("Building RGB composition")
-        compoimg = im.new("RGB", (totwidth, totheight), (255, 0, 0))
+        mode = "RGB"
+        compoarray = np.empty((totheight, totwidth, 3), dtype=np.uint8)
 
+    # The checks above guarantee that the tiles cover the whole composition : we simply copy each of them
+    # into its slice of the buffer (converting the other modes like paste would do).
     y = 0
     for line in f2nimages:
         x = 0
         for img in line:
-            box = (x, y, x+img.pilimage.size[0], y+img.pilimage.size[1])
-            compoimg.paste(img.pilimage, box)
-            x += img.pilimage.size[0]
-        y += img.pilimage.size[1]
+            width, height = img.pilimage.size
+            tile = img.pilimage if img.pilimage.mode == mode else img.pilimage.convert(mode)
+            compoarray[y:y+height, x:x+width] = np.asarray(tile)
+            x += width
+        y += height
+    compoimg = im.fromarray(compoarray)
 
     if verbose:
         print(("Writing compositions to %s...\n%i x %i pixels, mode %s" % (outfile, compoimg.size[0],
@@ -1013,5 +1129,9 @@ def isnumeric(value):
     """
     "0.2355" would return True.
     A little auxiliary function for command line parsing.
+    Anything is numeric if float() can parse it into a finite number ("1e-3" is, "--1.2.3", "nan" or "inf" are not).
     """
-    return str(value).replace(".", "").replace("-", "").isdigit()
+    try:
+        return math.isfinite(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return False
@@ -0,0 +1,167 @@
+import numpy as np
+import astropy.io.fits as ft
+
+from lensedquasarsurveyor.submodules import f2n
+
+
+def test_rebin_mean_and_max():
+    array = np.arange(6 * 4, dtype=np.float32).reshape((6, 4))
+
+    rebinned = f2n.rebin(array, (3, 2))
+    assert rebinned.shape == (3, 2)
+    assert np.allclose(rebinned, array.reshape(3, 2, 2, 2).mean(axis=(1, 3)))
+    assert rebinned.dtype == np.float32
+
+    # double precision stays double precision :
+    double = array.astype(np.float64) / 3.0
+    assert f2n.rebin(double, (3, 2)).dtype == np.float64
+    assert np.array_equal(f2n.rebin(double, (3, 2)), double.reshape(3, 2, 2, 2).mean(axis=(1, 3)))
+
+    maxed = f2n.remax(array, (3, 2))
+    assert np.array_equal(maxed, array.reshape(3, 2, 2, 2).max(axis=(1, 3)))
+
+    image = f2n.f2nimage(np.ones((7, 5), dtype=np.float32), verbose=False)
+    image.rebin(2)
+    assert image.numpyarray.shape == (3, 2)
+    assert image.binfactor == 2
+
+
+def test_init_does_not_copy_float32():
+    array = np.zeros((4, 3), dtype=np.float32)
+    image = f2n.f2nimage(array, verbose=False)
+    assert image.numpyarray is array
+
+    image = f2n.f2nimage(np.zeros((4, 3), dtype=np.float64).T, verbose=False)
+    assert image.numpyarray.dtype == np.float32
+    assert image.numpyarray.flags.c_contiguous
+
+    image = f2n.f2nimage(shape=(4, 3), fill=2.0, verbose=False)
+    assert np.all(image.numpyarray == 2.0)
+
+
+def test_drawstarfile_matches_drawstarlist(tmp_path):
+    catalog = tmp_path / "stars.txt"
+    catalog.write_text("# name x y\nstarA\t23.4\t45.6\tother stuff\nstarB 10 12\n")
+
+    array = np.zeros((60, 60), dtype=np.float32)
+    fromfile = f2n.f2nimage(array, verbose=False)
+    fromfile.setzscale(0.0, 1.0)
+    fromfile.makepilimage("lin")
+    fromfile.drawstarfile(str(catalog), r=5)
+
+    fromlist = f2n.f2nimage(array, verbose=False)
+    fromlist.setzscale(0.0, 1.0)
+    fromlist.makepilimage("lin")
+    fromlist.drawstarlist([{"name": "starA", "x": 23.4, "y": 45.6}, {"name": "starB", "x": 10.0, "y": 12.0}], r=5)
+
+    assert np.array_equal(np.asarray(fromfile.pilimage), np.asarray(fromlist.pilimage))
+    assert np.asarray(fromfile.pilimage).any()
+
+
+def test_makepilimage_rainbow():
+    array = np.linspace(0.0, 1.0, 50, dtype=np.float32).reshape((10, 5))
+    for scale in ("clin", "clog"):
+        image = f2n.f2nimage(array, verbose=False)
+        image.setzscale(0.0, 1.0)
+        image.makepilimage(scale)
+        rgb = np.asarray(image.pilimage)
+        assert image.pilimage.mode == "RGB"
+        # The maximum is red, the minimum violet :
+        assert tuple(rgb[0, -1]) == (255, 0, 0)
+        assert tuple(rgb[-1, 0]) == (255, 0, 255)
+
+        # NaN pixels get the colour of the minimum :
+        withnan = array.copy()
+        withnan[3, 3] = np.nan
+        nanimage = f2n.f2nimage(withnan, verbose=False)
+        nanimage.setzscale(0.0, 1.0)
+        nanimage.makepilimage(scale)
+        withnan[3, 3] = 0.0
+        zeroimage = f2n.f2nimage(withnan, verbose=False)
+        zeroimage.setzscale(0.0, 1.0)
+        zeroimage.makepilimage(scale)
+        assert np.array_equal(np.asarray(nanimage.pilimage), np.asarray(zeroimage.pilimage))
+
+
+def test_makepilimage_equal_cutoffs():
+    # z1 == z2 only gives degenerate gray levels, it does not raise :
+    constant = f2n.f2nimage(np.full((20, 20), 3.0, dtype=np.float32), verbose=False)
+    constant.setzscale("ex", "ex")
+    assert constant.z1 == constant.z2
+    allnan = f2n.f2nimage(np.full((20, 20), np.nan, dtype=np.float32), verbose=False)
+    allnan.setzscale("auto", "auto")
+    assert allnan.z1 == allnan.z2 == 0.0
+    for image in (constant, allnan):
+        for scale in ("lin", "log"):
+            image.pilimage = None
+            image.makepilimage(scale)
+            assert np.asarray(image.pilimage).shape == (20, 20)
+
+
+def test_native_integer_images():
+    array = (np.arange(40 * 30).reshape((40, 30)) % 1000).astype(np.int16)
+    image = f2n.f2nimage(array, verbose=False)
+    assert image.numpyarray.dtype == np.int16
+    image.setzscale("ex", "ex")
+    assert (image.z1, image.z2) == (0.0, 999.0)
+    image.makepilimage("log")
+
+    floatimage = f2n.f2nimage(array.astype(np.float32), verbose=False)
+    floatimage.setzscale("ex", "ex")
+    floatimage.makepilimage("log")
+    assert np.array_equal(np.asarray(image.pilimage), np.asarray(floatimage.pilimage))
+
+
+def test_setzscale_sample_size():
+    array = np.random.default_rng(0).normal(100.0, 10.0, size=(150, 130)).astype(np.float32)
+    image = f2n.f2nimage(array, verbose=False)
+    image.setzscale("flat", "flat", samplesizelimit=10000)
+    # Same result as with all the pixels, within the noise of a 10000 pixel sample :
+    full = f2n.f2nimage(array, verbose=False)
+    full.setzscale("flat", "flat", samplesizelimit=array.size)
+    assert abs(image.z1 - full.z1) < 1.0
+    assert abs(image.z2 - full.z2) < 1.0
+
+
+def test_setzscale_ignores_nan():
+    array = np.random.default_rng(0).normal(100.0, 10.0, size=(200, 200)).astype(np.float32)
+    array[::10] = np.nan
+    # also without the saturation cut, that drops the NaNs along :
+    image = f2n.f2nimage(array, verbose=False)
+    image.setzscale("auto", "auto", satlevel=-1)
+    assert abs(image.z2 - np.nanpercentile(array, 99.95)) < 2.0
+    assert 60.0 < image.z1 < 90.0
+
+
+def test_setzscale_empty_sample():
+    # Nothing left for the statistics, all NaN or all saturated : the NaN cutoffs are corrected to 0.
+    for value in (np.nan, 70000.0):
+        image = f2n.f2nimage(np.full((20, 20), value, dtype=np.float32), verbose=False)
+        image.setzscale("auto", "auto")
+        assert image.z1 == image.z2 == 0.0
+
+
+def test_from_fits(tmp_path):
+    array = np.arange(6 * 4, dtype=np.float32).reshape((6, 4))
+    fitsfile = str(tmp_path / "image.fits")
+    ft.writeto(fitsfile, array)
+
+    for memmap in (True, False):
+        image = f2n.f2nimage.from_fits(fitsfile, memmap=memmap, verbose=False)
+        # f2n uses the [x, y] convention, transposed with respect to the FITS data :
+        assert np.array_equal(image.numpyarray, array.T)
+        assert image.numpyarray.dtype == np.float32 and image.numpyarray.dtype.isnative
+        assert image.numpyarray.flags.c_contiguous
+    assert np.array_equal(f2n.fromfits(fitsfile, verbose=False).numpyarray, array.T)
+
+    ft.writeto(fitsfile, array.astype(np.int16), overwrite=True)
+    image = f2n.f2nimage.from_fits(fitsfile, verbose=False)
+    assert image.numpyarray.dtype == np.int16 and image.numpyarray.dtype.isnative
+    assert np.array_equal(image.numpyarray, array.T)
+
+
+def test_isnumeric():
+    for value in ("0.2355", "-3", "1e-3", 3, 2.5):
+        assert f2n.isnumeric(value)
+    for value in ("--1.2.3", "abc", "", None, "nan", "inf", "-Infinity", float("nan")):
+        assert not f2n.isnumeric(value)